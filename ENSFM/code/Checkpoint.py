@@ -0,0 +1,104 @@
+import glob
+import os
+import threading
+import numpy as np
+
+
+class Checkpointer(object):
+    '''
+    Periodic checkpoints of every global variable of a tf.compat.v1 session (model variables
+    and Adagrad slots), the epoch counter, the numpy RNG state and any extra arrays the
+    training loop needs to continue (e.g. the current order of the training rows).
+    The values are copied out of the session between two training steps and written to
+    disk on a background thread, so training only waits for the copy.
+    Files are <directory>/ckpt-<epoch>.npz; the last `keep` of them are kept.
+    '''
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        self.thread = None
+
+    def save(self, sess, epoch, extra=None):
+        variables = sess.graph.get_collection('variables')
+        values = sess.run(variables)
+        arrays = {'var/' + v.op.name: value for v, value in zip(variables, values)}
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss = np.random.get_state()
+        arrays.update({
+            'epoch': np.array(epoch),
+            'rng_keys': rng_keys,
+            'rng_pos': np.array(rng_pos),
+            'rng_has_gauss': np.array(rng_has_gauss),
+            'rng_gauss': np.array(rng_gauss),
+        })
+        for key, value in (extra or {}).items():
+            arrays['extra/' + key] = np.array(value)
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(epoch, arrays))
+        self.thread.start()
+
+    def _write(self, epoch, arrays):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'ckpt-%d.npz' % epoch)
+        # write under a temporary name so an interrupted write never looks like a checkpoint
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+        for old in self.list()[:-self.keep]:
+            os.remove(old)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def list(self):
+        paths = glob.glob(os.path.join(self.directory, 'ckpt-*.npz'))
+        return sorted(paths, key=lambda path: int(os.path.basename(path)[5:-4]))
+
+    def latest(self):
+        paths = self.list()
+        return paths[-1] if paths else None
+
+
+def checkpoint_path(path):
+    '''
+    :param path: checkpoint file, or checkpoint directory (its latest checkpoint is used)
+    :return: checkpoint file
+    '''
+    if os.path.isdir(path):
+        latest = Checkpointer(path).latest()
+        if latest is None:
+            raise ValueError('no checkpoint in %s' % path)
+        return latest
+    return path
+
+
+def read_epoch(path):
+    with np.load(checkpoint_path(path)) as ckpt:
+        return int(ckpt['epoch'])
+
+
+def restore(sess, path, warm_start=False):
+    '''
+    Load a checkpoint into the variables of sess
+    :param path: checkpoint file or directory
+    :param warm_start: only load the model variables (no optimizer slots, epoch or RNG state)
+                       whose name and shape match, leaving the others at their initial values
+    :return: (epoch the checkpoint was written after, dict of extra arrays); (None, {}) for a warm start
+    '''
+    with np.load(checkpoint_path(path)) as ckpt:
+        for v in sess.graph.get_collection('variables'):
+            key = 'var/' + v.op.name
+            if warm_start and ('Adagrad' in v.op.name or key not in ckpt.files):
+                continue
+            value = ckpt[key]
+            if warm_start and value.shape != tuple(v.shape.as_list()):
+                continue
+            v.load(value, sess)
+        if warm_start:
+            return None, {}
+        np.random.set_state(('MT19937', ckpt['rng_keys'], int(ckpt['rng_pos']),
+                             int(ckpt['rng_has_gauss']), float(ckpt['rng_gauss'])))
+        extra = {key[len('extra/'):]: ckpt[key] for key in ckpt.files if key.startswith('extra/')}
+        return int(ckpt['epoch']), extra
@@ -0,0 +1,226 @@
+import numpy as np
+
+
+def _truncated_normal(rng, shape, stddev=0.01):
+    values = rng.normal(0.0, stddev, shape)
+    outside = np.abs(values) > 2 * stddev
+    while outside.any():
+        values[outside] = rng.normal(0.0, stddev, outside.sum())
+        outside = np.abs(values) > 2 * stddev
+    return values
+
+
+class ENSFMSolver(object):
+    '''
+    eALS-style coordinate descent for the ENSFM loss, as an alternative to Adagrad.
+
+    With p_u = [s_u * h, c_u, 1] and q_v = [t_v, 1, c_v] (s/t: summed feature embeddings,
+    c: FM cross term + biases) a score is r_uv = p_u . q_v, and the loss is
+        w * sum_{u, v} r_uv^2 + sum_{(u, v) observed} ((1 - w) r_uv^2 - 2 r_uv) + L2
+    The pairwise FM cross term is linear in every single embedding coordinate, so r_uv is
+    linear in each parameter and the loss is a quadratic in it: one Newton step is the
+    exact minimizer. The sum over all (user, item) pairs only enters through the Gram
+    matrices Q = sum_v q_v q_v^T and P = sum_u p_u p_u^T, exactly as in the gram loss.
+    Features of one field never share a user (or item), so every coordinate of one field
+    is solved at once; H_i and H_s are solved as blocks. An epoch is a sweep over the
+    user side (biases, then every field x dimension of uidW), the item side, H_i and H_s.
+    Every update lowers the training loss. No dropout is applied.
+    Memory is O(users + items + observed pairs) times embedding_size + 2.
+    '''
+
+    def __init__(self, data, embedding_size, args, random_seed=2019, pair_chunk=65536):
+        self.d = embedding_size
+        self.weight1 = args.negative_weight
+        self.lambda_bilinear = args.lambda_bilinear
+        self.pair_chunk = pair_chunk
+        rng = np.random.RandomState(random_seed)
+        # same shapes and initial distributions as the TensorFlow model
+        self.uidW = _truncated_normal(rng, (data.user_field_M, embedding_size))
+        self.iidW = _truncated_normal(rng, (data.item_field_M + 1, embedding_size))
+        self.H_i = np.full(embedding_size, 0.01)
+        self.H_s = np.full(embedding_size, 0.01)
+        self.u_bias = _truncated_normal(rng, data.user_field_M)
+        self.i_bias = _truncated_normal(rng, data.item_field_M)
+        self.bias = 0.0
+
+        self.user_features = np.asarray(data.user_train, dtype=np.int64)
+        self.item_features = np.asarray(data.item_map_list, dtype=np.int64)
+        self.pos_row = np.repeat(np.arange(len(self.user_features)), np.diff(data.train_indptr))
+        self.pos_item = np.asarray(data.train_items, dtype=np.int64)
+        for name, features in [('user', self.user_features), ('item', self.item_features)]:
+            fields = [set(np.unique(features[:, j])) for j in range(features.shape[1])]
+            if any(fields[a] & fields[b] for a in range(len(fields)) for b in range(a + 1, len(fields))):
+                raise ValueError('the %s fields share feature ids; the solver needs disjoint fields' % name)
+        self._refresh()
+
+    def _towers(self):
+        s = self.uidW[self.user_features].sum(1)
+        x_u = 0.5 * (np.square(s) - np.square(self.uidW[self.user_features]).sum(1))
+        t = self.iidW[self.item_features].sum(1)
+        x_v = 0.5 * (np.square(t) - np.square(self.iidW[self.item_features]).sum(1))
+        u_bias = self.u_bias[self.user_features].sum(1) + self.bias
+        i_bias = self.i_bias[self.item_features].sum(1)
+        return s, x_u, u_bias, t, x_v, i_bias
+
+    def _refresh(self):
+        # recompute the towers and the observed scores from the parameters
+        s, x_u, u_bias, t, x_v, i_bias = self._towers()
+        ones_u, ones_v = np.ones((len(s), 1)), np.ones((len(t), 1))
+        self.s = s
+        self.p = np.hstack([s * self.H_i, (x_u.dot(self.H_s) + u_bias)[:, None], ones_u])
+        self.q = np.hstack([t, ones_v, (x_v.dot(self.H_s) + i_bias)[:, None]])
+        self.r = np.empty(len(self.pos_row))
+        for start in range(0, len(self.pos_row), self.pair_chunk):
+            rows = self.pos_row[start:start + self.pair_chunk]
+            items = self.pos_item[start:start + self.pair_chunk]
+            self.r[start:start + self.pair_chunk] = (self.p[rows] * self.q[items]).sum(1)
+
+    def _step(self, X, gram, cache, features, pair_own, pair_other, Y, k, a, c, beta, n_features, lam, values):
+        '''
+        Exact update of one parameter per feature in `features`, for every feature at once
+        :param X: tower matrix of the updated side (p or q), Y: the other one, gram: Gram matrix of Y
+        :param cache: X.dot(gram), kept up to date
+        :param features: feature id of every row of X (rows with equal ids share the parameter)
+        :param pair_own, pair_other: row of X and of Y of every observed pair
+        :param k, a, c, beta: a change delta of the parameter moves row i of X by
+                              delta * (a e_k + beta_i e_c)
+        :param lam, values: L2 weight and current values of the parameters (lam 0: no L2)
+        :return: change of every parameter, indexed by feature id
+        '''
+        w = self.weight1
+        A = a * cache[:, k] + beta * cache[:, c]
+        B = a * a * gram[k, k] + 2 * a * beta * gram[k, c] + beta * beta * gram[c, c]
+        phi = a * Y[pair_other, k] + beta[pair_own]
+        pair_features = features[pair_own]
+        # half the first and second derivative of the loss for every feature
+        grad = w * np.bincount(features, A, n_features) + np.bincount(pair_features, ((1 - w) * self.r - 1) * phi, n_features)
+        hess = w * np.bincount(features, B, n_features) + (1 - w) * np.bincount(pair_features, phi * phi, n_features)
+        if lam:
+            grad += 0.5 * lam * values
+            hess += 0.5 * lam
+        delta = np.zeros(n_features)
+        present = hess > 0
+        delta[present] = -grad[present] / hess[present]
+        row_delta = delta[features]
+        X[:, k] += a * row_delta
+        X[:, c] += beta * row_delta
+        cache += np.stack([a * row_delta, beta * row_delta], 1).dot(gram[[k, c]])
+        self.r += row_delta[pair_own] * phi
+        return delta
+
+    def _sweep_users(self):
+        d, p, q = self.d, self.p, self.q
+        gram = q.T.dot(q)
+        cache = p.dot(gram)
+        ones = np.ones(len(p))
+        args = (p, gram, cache)
+        pairs = (self.pos_row, self.pos_item, q)
+        self.bias += self._step(*args, np.zeros(len(p), dtype=np.int64), *pairs, 0, 0.0, d, ones, 1, 0.0, None)[0]
+        for j in range(self.user_features.shape[1]):
+            f = self.user_features[:, j]
+            self.u_bias += self._step(*args, f, *pairs, 0, 0.0, d, ones, len(self.u_bias), 0.0, None)
+        for k in range(d):
+            for j in range(self.user_features.shape[1]):
+                f = self.user_features[:, j]
+                # the cross term of a user is linear in one of its features: rho = s - e
+                beta = self.H_s[k] * (self.s[:, k] - self.uidW[f, k])
+                delta = self._step(*args, f, *pairs, k, self.H_i[k], d, beta, len(self.uidW),
+                                   self.lambda_bilinear[0], self.uidW[:, k])
+                self.uidW[:, k] += delta
+                self.s[:, k] += delta[f]
+
+    def _sweep_items(self):
+        d, p, q = self.d, self.p, self.q
+        gram = p.T.dot(p)
+        cache = q.dot(gram)
+        ones = np.ones(len(q))
+        t = q[:, :d]  # view: kept up to date by _step
+        args = (q, gram, cache)
+        pairs = (self.pos_item, self.pos_row, p)
+        for j in range(self.item_features.shape[1]):
+            f = self.item_features[:, j]
+            self.i_bias += self._step(*args, f, *pairs, 0, 0.0, d + 1, ones, len(self.i_bias), 0.0, None)
+        for k in range(d):
+            for j in range(self.item_features.shape[1]):
+                f = self.item_features[:, j]
+                beta = self.H_s[k] * (t[:, k] - self.iidW[f, k])
+                delta = self._step(*args, f, *pairs, k, 1.0, d + 1, beta, len(self.iidW),
+                                   self.lambda_bilinear[1], self.iidW[:, k])
+                self.iidW[:, k] += delta
+
+    def _pair_sums(self, z_fn, r0):
+        # sums over the observed pairs of z z^T and (1 - (1 - w) r0) z, with z = z_fn(rows, items)
+        # the vector a score is linear in and r0 the score without the block being solved
+        w = self.weight1
+        zz, zb = 0.0, 0.0
+        for start in range(0, len(self.pos_row), self.pair_chunk):
+            z = z_fn(self.pos_row[start:start + self.pair_chunk], self.pos_item[start:start + self.pair_chunk])
+            zz = zz + z.T.dot(z)
+            zb = zb + z.T.dot(1 - (1 - w) * r0[start:start + self.pair_chunk])
+        return zz, zb
+
+    def _solve_H_i(self):
+        # r_uv = H . (p_raw_u * q_v) with p_raw = [s, c_u, 1]: quadratic in H_i
+        d, w = self.d, self.weight1
+        p_raw = np.hstack([self.s, self.p[:, d:]])
+        gram = p_raw.T.dot(p_raw) * self.q.T.dot(self.q)
+        zz, zb = self._pair_sums(lambda rows, items: p_raw[rows] * self.q[items], np.zeros(len(self.r)))
+        A = w * gram + (1 - w) * zz
+        # H_i_emb[d:] stays 1
+        self.H_i = np.linalg.solve(A[:d, :d] + 1e-10 * np.eye(d), zb[:d] - A[:d, d:].sum(1))
+        self._refresh()
+
+    def _solve_H_s(self):
+        # r_uv = r0_uv + H_s . (x_u + x_v): quadratic in H_s
+        d, w = self.d, self.weight1
+        s, x_u, u_bias, t, x_v, i_bias = self._towers()
+        p0 = np.hstack([s * self.H_i, u_bias[:, None], np.ones((len(s), 1))])
+        q0 = np.hstack([t, np.ones((len(t), 1)), i_bias[:, None]])
+        n_u, n_v = len(x_u), len(x_v)
+        su, sv = x_u.sum(0), x_v.sum(0)
+        yy = n_v * x_u.T.dot(x_u) + n_u * x_v.T.dot(x_v) + np.outer(su, sv) + np.outer(sv, su)
+        # sum_{u, v} r0_uv (x_u + x_v)
+        ry = x_u.T.dot(p0.dot(q0.sum(0))) + x_v.T.dot(q0.dot(p0.sum(0)))
+        r0 = np.empty(len(self.pos_row))
+        for start in range(0, len(self.pos_row), self.pair_chunk):
+            rows = self.pos_row[start:start + self.pair_chunk]
+            items = self.pos_item[start:start + self.pair_chunk]
+            r0[start:start + self.pair_chunk] = (p0[rows] * q0[items]).sum(1)
+        zz, zb = self._pair_sums(lambda rows, items: x_u[rows] + x_v[items], r0)
+        self.H_s = np.linalg.solve(w * yy + (1 - w) * zz + 1e-10 * np.eye(d), zb - w * ry)
+        self._refresh()
+
+    def loss(self):
+        '''
+        :return: (loss, loss without L2, L2 term) over all training users, as in the gram loss
+        '''
+        w = self.weight1
+        loss1 = w * np.sum(self.q.T.dot(self.q) * self.p.T.dot(self.p))
+        loss1 += np.sum((1 - w) * np.square(self.r) - 2 * self.r)
+        reg = 0.0
+        if self.lambda_bilinear[0] != 0.0:
+            reg += self.lambda_bilinear[0] * 0.5 * np.sum(np.square(self.uidW))
+        if self.lambda_bilinear[1] != 0.0:
+            reg += self.lambda_bilinear[1] * 0.5 * np.sum(np.square(self.iidW))
+        return loss1 + reg, loss1, reg
+
+    def epoch(self):
+        self._sweep_users()
+        self._sweep_items()
+        self._solve_H_i()
+        self._solve_H_s()
+        return self.loss()
+
+    def item_tower(self):
+        '''
+        :return: (q_emb [items, d+2], H_i_emb [d+2, 1]) like ENSFM_tf2.ENSFMModule.item_tower
+        '''
+        return self.q.astype(np.float32), np.concatenate([self.H_i, [1.0, 1.0]])[:, None].astype(np.float32)
+
+    def score(self, input_u, q_emb, H_i_emb):
+        input_u = np.asarray(input_u)
+        s = self.uidW[input_u].sum(1)
+        x = 0.5 * (np.square(s) - np.square(self.uidW[input_u]).sum(1))
+        c = x.dot(self.H_s) + self.u_bias[input_u].sum(1) + self.bias
+        p_emb = np.hstack([s, c[:, None], np.ones((len(s), 1))]).astype(np.float32)
+        return (p_emb * H_i_emb.T).dot(q_emb.T)
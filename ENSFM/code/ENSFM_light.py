@@ -1,13 +1,29 @@
 import numpy as np
-import tensorflow as tf
 import os
 import time
 import sys
 import argparse
+import copy
 import itertools
 import LoadData as DATA
+import ENSFM_eals
+import Checkpoint
+import Metrics
+import Telemetry
 
-def parse_args():
+# TensorFlow and the modules built on it take seconds to import, so they are only loaded by
+# import_tf() once a model is about to be built: --help, argument errors and the parent
+# process of a search stay fast
+tf = InputPipeline = ENSFM_tf2 = ENSFM_stack = None
+
+def import_tf():
+    global tf, InputPipeline, ENSFM_tf2, ENSFM_stack
+    import tensorflow as tf
+    import InputPipeline
+    import ENSFM_tf2
+    import ENSFM_stack
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Run ENSFM")
     parser.add_argument('--dataset', nargs='?', default='ml-1m',
                         help='Choose a dataset: lastfm, frappe, ml-1m, yelp2018, amazonbook')
@@ -16,7 +32,7 @@ def parse_args():
     parser.add_argument('--epochs', type=int, default=50,  # For grid search, run a small number of epochs first
                         help='Number of epochs.')
     parser.add_argument('--verbose', type=int, default=5,
-                        help='Interval of evaluation.')
+                        help='Interval of evaluation (0: only evaluate after the last epoch).')
     parser.add_argument('--embed_size', type=int, default=64,
                         help='Embedding size.')
     parser.add_argument('--lr', type=float, default=0.05,
@@ -27,7 +43,59 @@ def parse_args():
                         help='weight of non-observed data')
     parser.add_argument('--topK', nargs='?', type=int, default=[5,10,20],
                         help='topK for hr/ndcg')
-    return parser.parse_args()
+    parser.add_argument('--score_mode', nargs='?', default='gemm', choices=['einsum', 'gemm', 'chunked'],
+                        help='Scoring path for evaluation: einsum (reference), gemm or chunked')
+    parser.add_argument('--item_chunk', type=int, default=65536,
+                        help='Item block size for --score_mode chunked')
+    parser.add_argument('--check_scores', action='store_true',
+                        help='Check that every scoring path matches the einsum reference before training')
+    parser.add_argument('--check_reuse', action='store_true',
+                        help='Check that a trial on a reused graph matches the same trial on a fresh graph before the search')
+    parser.add_argument('--loss_mode', nargs='?', default='gram', choices=['einsum', 'gram'],
+                        help='Whole-data loss term: einsum (reference) or gram')
+    parser.add_argument('--cache_items', type=int, default=1,
+                        help='Compute the item tower once per evaluate() call (1) or for every batch (0)')
+    parser.add_argument('--input_pipeline', nargs='?', default='tfdata', choices=['feed', 'tfdata'],
+                        help='Training input: feed (numpy slices through feed_dict) or tfdata (prefetching tf.data iterator)')
+    parser.add_argument('--positives', nargs='?', default='padded', choices=['padded', 'ragged'],
+                        help='Positive lists: padded to max_positive_len or ragged (needs --input_pipeline tfdata)')
+    parser.add_argument('--engine', nargs='?', default='graph', choices=['graph', 'tf2'],
+                        help='graph (tf.compat.v1 Session) or tf2 (tf.Module with XLA-compiled steps)')
+    parser.add_argument('--lambda_bilinear', nargs=2, type=float, default=[0.0, 0.0],
+                        help='L2 weights of uidW and iidW')
+    parser.add_argument('--reg_mode', nargs='?', default=None, choices=['dense', 'lazy'],
+                        help='L2 on the whole uidW/iidW tables (dense) or only on the rows a batch reads (lazy, the default '
+                             'of the graph model; --engine tf2 and --optimizer eals always apply dense)')
+    parser.add_argument('--optimizer', nargs='?', default='adagrad', choices=['adagrad', 'eals'],
+                        help='adagrad (mini-batch) or eals (NumPy coordinate descent on the whole data, see ENSFM_eals)')
+    parser.add_argument('--stack', type=int, default=1,
+                        help='Grid search: train this many (dropout, negative_weight) points of the same lr together in one graph')
+    parser.add_argument('--run_log', nargs='?', default=None,
+                        help='JSONL telemetry log of the run (default: <dataset dir>/runs/ENSFM_light-<time>-<pid>.jsonl)')
+    parser.add_argument('--profile_steps', nargs='?', default=None,
+                        help='Capture a TensorFlow profiler trace of the training steps start:stop of each experiment')
+    parser.add_argument('--profile_dir', nargs='?', default=None,
+                        help='Profiler trace directory (default: <dataset dir>/runs/profile)')
+    args = parser.parse_args(argv)
+    # the tf.compat.v1 graph model trains with Adagrad; otherwise ENSFM_tf2 or ENSFM_eals trains and scores
+    args.use_graph = args.engine == 'graph' and args.optimizer == 'adagrad'
+    if args.positives == 'ragged' and args.input_pipeline != 'tfdata':
+        parser.error('--positives ragged needs --input_pipeline tfdata')
+    if args.positives == 'ragged' and args.engine == 'tf2':
+        parser.error('--engine tf2 trains on padded positives')
+    if args.stack > 1 and not args.use_graph:
+        parser.error('--stack needs --engine graph and --optimizer adagrad')
+    # the tf2 module and the eals solver train the gram loss with whole-table L2 and score with gemm
+    if not args.use_graph:
+        ignored = [flag for flag, given in [('--score_mode %s' % args.score_mode, args.score_mode != 'gemm'),
+                                             ('--loss_mode %s' % args.loss_mode, args.loss_mode != 'gram'),
+                                             ('--reg_mode lazy', args.reg_mode == 'lazy'),
+                                             ('--check_scores', args.check_scores)] if given]
+        if ignored:
+            parser.error('%s: only supported with --engine graph and --optimizer adagrad' % ', '.join(ignored))
+    if args.reg_mode is None:
+        args.reg_mode = 'lazy' if args.use_graph else 'dense'
+    return args
 
 def _writeline_and_time(s):
     sys.stdout.write(s)
@@ -36,18 +104,40 @@ def _writeline_and_time(s):
 
 class ENSFM:
     def __init__(self, item_attribute, user_field_M, item_field_M, embedding_size, max_item_pu, args):
+        # the graph is built from the module-level tf, so load it here if no caller has yet
+        import_tf()
         self.embedding_size = embedding_size
         self.max_item_pu = max_item_pu
         self.user_field_M = user_field_M
         self.item_field_M = item_field_M
         self.weight1 = args.negative_weight
         self.item_attribute = item_attribute
-        self.lambda_bilinear = [0.0, 0.0]
+        self.lambda_bilinear = args.lambda_bilinear
+        self.reg_mode = args.reg_mode
+        self.score_mode = args.score_mode
+        self.item_chunk = args.item_chunk
+        self.loss_mode = args.loss_mode
+        self.ragged_positives = args.positives == 'ragged'
 
-    def _create_placeholders(self):
-        self.input_u = tf.compat.v1.placeholder(tf.int32, [None, None], name="input_u_feature")
-        self.input_ur = tf.compat.v1.placeholder(tf.int32, [None, self.max_item_pu], name="input_ur")
+    def _create_placeholders(self, inputs=None):
+        if inputs is None:
+            self.input_u = tf.compat.v1.placeholder(tf.int32, [None, None], name="input_u_feature")
+            if self.ragged_positives:
+                self.input_pos_row = tf.compat.v1.placeholder(tf.int32, [None], name="input_pos_row")
+                self.input_pos_item = tf.compat.v1.placeholder(tf.int32, [None], name="input_pos_item")
+            else:
+                self.input_ur = tf.compat.v1.placeholder(tf.int32, [None, self.max_item_pu], name="input_ur")
+        else:
+            # training reads from a tf.data iterator; evaluation still feeds input_u directly
+            self.input_u = tf.compat.v1.placeholder_with_default(inputs[0], [None, None], name="input_u_feature")
+            if self.ragged_positives:
+                self.input_pos_row = tf.compat.v1.placeholder_with_default(inputs[1], [None], name="input_pos_row")
+                self.input_pos_item = tf.compat.v1.placeholder_with_default(inputs[2], [None], name="input_pos_item")
+            else:
+                self.input_ur = tf.compat.v1.placeholder_with_default(inputs[1], [None, self.max_item_pu], name="input_ur")
         self.dropout_keep_prob = tf.compat.v1.placeholder(tf.float32, name="dropout_keep_prob")
+        # fed by train_step1, so trials with another negative_weight can reuse the graph
+        self.weight1 = tf.compat.v1.placeholder_with_default(float(self.weight1), [], name="negative_weight")
 
     def _create_variables(self):
         self.uidW = tf.Variable(tf.random.truncated_normal(shape=[self.user_field_M, self.embedding_size], mean=0.0, stddev=0.01), dtype=tf.float32, name="uidW")
@@ -57,14 +147,23 @@ class ENSFM:
         self.u_bias = tf.Variable(tf.random.truncated_normal(shape=[self.user_field_M, 1], mean=0.0, stddev=0.01), dtype=tf.float32, name="u_bias")
         self.i_bias = tf.Variable(tf.random.truncated_normal(shape=[self.item_field_M, 1], mean=0.0, stddev=0.01), dtype=tf.float32, name="i_bias")
         self.bias = tf.Variable(tf.constant(0.0), name='bias')
+        # training steps taken, the counter of the stateless dropout masks (see _dropout)
+        self.dropout_step = tf.Variable(tf.constant(0, tf.int64), trainable=False, name='dropout_step')
+
+    def _dropout(self, x, stream):
+        # inverted dropout with masks drawn from (graph seed, step, stream) alone: a trial that
+        # reuses a graph resets dropout_step with the other variables and so draws the same masks
+        # as a fresh graph, whatever trials ran in it before
+        seed = tf.stack([tf.constant(tf.compat.v1.get_default_graph().seed or 0, tf.int64), 2 * self.dropout_step + stream])
+        keep = tf.random.stateless_uniform(tf.shape(x), seed) < self.dropout_keep_prob
+        return tf.where(keep, x / self.dropout_keep_prob, tf.zeros_like(x))
 
     def _create_vectors(self):
         self.user_feature_emb = tf.nn.embedding_lookup(self.uidW, self.input_u)
         self.summed_user_emb = tf.reduce_sum(self.user_feature_emb, 1)
         
-        # Use TF 1.x dropout syntax with keep_prob
-        self.H_i = tf.compat.v1.nn.dropout(self.H_i, keep_prob=self.dropout_keep_prob)
-        self.H_s = tf.compat.v1.nn.dropout(self.H_s, keep_prob=self.dropout_keep_prob)
+        self.H_i = self._dropout(self.H_i, 0)
+        self.H_s = self._dropout(self.H_s, 1)
         
         self.all_item_feature_emb = tf.nn.embedding_lookup(self.iidW, self.item_attribute)
         self.summed_all_item_emb = tf.reduce_sum(self.all_item_feature_emb, 1)
@@ -86,32 +185,71 @@ class ENSFM:
         self.H_i_emb = tf.concat([self.H_i, [[1.0]], [[1.0]]], 0)
 
     def _create_inference(self):
+        if self.ragged_positives:
+            # one row per observed (user, item) pair, so the work follows the real interactions
+            self.pos_item = tf.gather(self.q_emb, self.input_pos_item)
+            self.pos_r = tf.gather(self.p_emb, self.input_pos_row) * self.pos_item
+            self.pos_r = tf.matmul(self.pos_r, self.H_i_emb)
+            return
         self.pos_item = tf.nn.embedding_lookup(self.q_emb, self.input_ur)
-        # data.item_bind_M is assumed to be set by the LoadData module
-        self.pos_num_r = tf.cast(tf.not_equal(self.input_ur, data.item_bind_M), 'float32')
+        # the last row of item_attribute is the padding item (LoadData.item_bind_M)
+        self.pos_num_r = tf.cast(tf.not_equal(self.input_ur, len(self.item_attribute) - 1), 'float32')
         self.pos_item = tf.einsum('ab,abc->abc', self.pos_num_r, self.pos_item)
         self.pos_r = tf.einsum('ac,abc->abc', self.p_emb, self.pos_item)
         self.pos_r = tf.einsum('ajk,kl->ajl', self.pos_r, self.H_i_emb)
         self.pos_r = tf.reshape(self.pos_r, [-1, self.max_item_pu])
 
-    def _pre(self):
-        dot = tf.einsum('ac,bc->abc', self.p_emb, self.q_emb)
-        pre = tf.einsum('ajk,kl->aj', dot, self.H_i_emb)
-        return pre
+    def _pre(self, score_mode=None):
+        score_mode = score_mode or self.score_mode
+        if score_mode == 'einsum':
+            # reference path: materializes a [batch, items, d+2] tensor
+            dot = tf.einsum('ac,bc->abc', self.p_emb, self.q_emb)
+            pre = tf.einsum('ajk,kl->aj', dot, self.H_i_emb)
+            return pre
+        # fold H_i_emb into the user side so scoring is one [batch, d+2] x [d+2, items] GEMM
+        p_weighted = self.p_emb * tf.transpose(self.H_i_emb)
+        if score_mode == 'gemm':
+            return tf.matmul(p_weighted, self.q_emb, transpose_b=True)
+        # chunked: score item blocks of size item_chunk one after another
+        n_items = tf.shape(self.q_emb)[0]
+        n_chunks = (n_items + self.item_chunk - 1) // self.item_chunk
+        q_pad = tf.pad(self.q_emb, [[0, n_chunks * self.item_chunk - n_items], [0, 0]])
+        q_blocks = tf.reshape(q_pad, [n_chunks, self.item_chunk, self.embedding_size + 2])
+        pre = tf.map_fn(lambda q: tf.matmul(p_weighted, q, transpose_b=True), q_blocks,
+                        parallel_iterations=1)
+        pre = tf.reshape(tf.transpose(pre, [1, 0, 2]), [tf.shape(p_weighted)[0], -1])
+        return pre[:, :n_items]
 
     def _create_loss(self):
+        if self.loss_mode == 'einsum':
+            # reference path: builds [items, d+2, d+2] and [batch, d+2, d+2] intermediates
+            self.q_gram = tf.reduce_sum(tf.einsum('ab,ac->abc', self.q_emb, self.q_emb), 0)
+            self.p_gram = tf.reduce_sum(tf.einsum('ab,ac->abc', self.p_emb, self.p_emb), 0)
+        else:
+            self.q_gram = tf.matmul(self.q_emb, self.q_emb, transpose_a=True)
+            self.p_gram = tf.matmul(self.p_emb, self.p_emb, transpose_a=True)
         self.loss1 = self.weight1 * tf.reduce_sum(
-            tf.reduce_sum(tf.reduce_sum(tf.einsum('ab,ac->abc', self.q_emb, self.q_emb), 0)
-                          * tf.reduce_sum(tf.einsum('ab,ac->abc', self.p_emb, self.p_emb), 0)
-                          * tf.matmul(self.H_i_emb, self.H_i_emb, transpose_b=True), 0), 0)
+            self.q_gram * self.p_gram * tf.matmul(self.H_i_emb, self.H_i_emb, transpose_b=True))
         self.loss1 += tf.reduce_sum((1.0 - self.weight1) * tf.square(self.pos_r) - 2.0 * self.pos_r)
-        self.l2_loss0 = tf.nn.l2_loss(self.uidW)
-        self.l2_loss1 = tf.nn.l2_loss(self.iidW)
-        self.loss = self.loss1 + self.lambda_bilinear[0] * self.l2_loss0 + self.lambda_bilinear[1] * self.l2_loss1
-        self.reg_loss = self.lambda_bilinear[0] * self.l2_loss0 + self.lambda_bilinear[1] * self.l2_loss1
+        # a term over a whole table, even with a zero weight, turns its IndexedSlices gradient
+        # dense and makes Adagrad update every row; lazy mode only regularizes the rows read
+        if self.reg_mode == 'lazy':
+            user_rows = tf.unique(tf.reshape(self.input_u, [-1]))[0]
+            item_rows = np.unique(self.item_attribute)
+            self.l2_loss0 = tf.nn.l2_loss(tf.gather(self.uidW, user_rows))
+            self.l2_loss1 = tf.nn.l2_loss(tf.gather(self.iidW, item_rows))
+        else:
+            self.l2_loss0 = tf.nn.l2_loss(self.uidW)
+            self.l2_loss1 = tf.nn.l2_loss(self.iidW)
+        self.reg_loss = tf.constant(0.0)
+        if self.lambda_bilinear[0] != 0.0:
+            self.reg_loss += self.lambda_bilinear[0] * self.l2_loss0
+        if self.lambda_bilinear[1] != 0.0:
+            self.reg_loss += self.lambda_bilinear[1] * self.l2_loss1
+        self.loss = self.loss1 + self.reg_loss
 
-    def _build_graph(self):
-        self._create_placeholders()
+    def _build_graph(self, inputs=None):
+        self._create_placeholders(inputs)
         self._create_variables()
         self._create_vectors()
         self._create_inference()
@@ -119,141 +257,277 @@ class ENSFM:
         self.pre = self._pre()
 
 def train_step1(u_batch, y_batch, args):
+    # u_batch/y_batch are None when the batch comes from the tf.data iterator
     feed_dict = {
-        deep.input_u: u_batch,
-        deep.input_ur: y_batch,
         deep.dropout_keep_prob: args.dropout,
+        deep.weight1: args.negative_weight,
+        learning_rate: args.lr,
     }
-    _, loss, loss1, loss2, _ = sess.run(
-        [train_op1, deep.loss, deep.loss1, deep.reg_loss, deep.p_emb],
+    if u_batch is not None:
+        feed_dict[deep.input_u] = u_batch
+        feed_dict[deep.input_ur] = y_batch
+    _, loss, loss1, loss2 = sess.run(
+        [train_op1, deep.loss, deep.loss1, deep.reg_loss],
         feed_dict)
     return loss, loss1, loss2
 
+def check_scores():
+    # compare every scoring path against the einsum reference on the first evaluation batch
+    feed_dict = {
+        deep.input_u: data.user_test[:128],
+        deep.dropout_keep_prob: 1.0,
+    }
+    reference = sess.run(deep._pre('einsum'), feed_dict)
+    for score_mode in ['gemm', 'chunked']:
+        pre = sess.run(deep._pre(score_mode), feed_dict)
+        np.testing.assert_allclose(pre, reference, rtol=1e-4, atol=1e-6)
+        print("score_mode %s matches einsum: max abs diff %.3g" % (score_mode, np.abs(pre - reference).max()))
+
 # Modify evaluate() as needed to return metrics; here it only prints for simplicity.
 def evaluate():
     eva_batch = 128
-    recall50 = []
-    recall100 = []
-    recall200 = []
-    ndcg50 = []
-    ndcg100 = []
-    ndcg200 = []
-    user_features = data.user_test
+    engine = Metrics.TopKMetrics(args.topK)
+    user_features, test_user_id = data.unique_test_users()
+    item_feed = {}
+    # the tf2 module and the eals solver both score outside the session
+    if not args.use_graph:
+        q_emb, H_i_emb = deep.item_tower()
+    elif args.cache_items:
+        # the item side does not depend on the users: run it once and feed it back for every batch
+        q_emb, H_i_emb = sess.run([deep.q_emb, deep.H_i_emb], {deep.dropout_keep_prob: 1.0})
+        item_feed = {deep.q_emb: q_emb, deep.H_i_emb: H_i_emb}
     ll = int(len(user_features) / eva_batch) + 1
     for batch_num in range(ll):
         start_index = batch_num * eva_batch
         end_index = min((batch_num + 1) * eva_batch, len(user_features))
         u_batch = user_features[start_index:end_index]
-        batch_users = end_index - start_index
-        feed_dict = {
-            deep.input_u: u_batch,
-            deep.dropout_keep_prob: 1.0,
-        }
-        pre = sess.run(deep.pre, feed_dict)
-        pre = np.array(pre)
-        pre = np.delete(pre, -1, axis=1)
-        user_id = []
-        for one in u_batch:
-            user_id.append(data.binded_users["-".join([str(item) for item in one])])
-        idx = np.zeros_like(pre, dtype=bool)
-        idx[data.Train_data[user_id].nonzero()] = True
-        pre[idx] = -np.inf
-        recall = []
-        for kj in args.topK:
-            idx_topk_part = np.argpartition(-pre, kj, 1)
-            pre_bin = np.zeros_like(pre, dtype=bool)
-            pre_bin[np.arange(batch_users)[:, np.newaxis], idx_topk_part[:, :kj]] = True
-            true_bin = np.zeros_like(pre, dtype=bool)
-            true_bin[data.Test_data[user_id].nonzero()] = True
-            tmp = (np.logical_and(true_bin, pre_bin).sum(axis=1)).astype(np.float32)
-            recall.append(tmp / np.minimum(kj, true_bin.sum(axis=1)))
-        ndcg = []
-        for kj in args.topK:
-            idx_topk_part = np.argpartition(-pre, kj, 1)
-            topk_part = pre[np.arange(batch_users)[:, np.newaxis], idx_topk_part[:, :kj]]
-            idx_part = np.argsort(-topk_part, axis=1)
-            idx_topk = idx_topk_part[np.arange(end_index - start_index)[:, np.newaxis], idx_part]
-            tp = np.log(2) / np.log(np.arange(2, kj + 2))
-            test_batch = data.Test_data[user_id]
-            DCG = (test_batch[np.arange(batch_users)[:, np.newaxis], idx_topk].toarray() * tp).sum(axis=1)
-            IDCG = np.array([(tp[:min(n, kj)]).sum() for n in test_batch.getnnz(axis=1)])
-            ndcg.append(DCG / IDCG)
-        recall50.append(recall[0])
-        recall100.append(recall[1])
-        recall200.append(recall[2])
-        ndcg50.append(ndcg[0])
-        ndcg100.append(ndcg[1])
-        ndcg200.append(ndcg[2])
-    recall50 = np.hstack(recall50)
-    recall100 = np.hstack(recall100)
-    recall200 = np.hstack(recall200)
-    ndcg50 = np.hstack(ndcg50)
-    ndcg100 = np.hstack(ndcg100)
-    ndcg200 = np.hstack(ndcg200)
-    print("HR@10:", np.mean(recall100), "NDCG@10:", np.mean(ndcg100))
+        with run_log.phase('eval_score'):
+            if not args.use_graph:
+                pre = deep.score(np.array(u_batch, dtype=np.int32), q_emb, H_i_emb)
+            else:
+                feed_dict = {
+                    deep.input_u: u_batch,
+                    deep.dropout_keep_prob: 1.0,
+                }
+                feed_dict.update(item_feed)
+                pre = sess.run(deep.pre, feed_dict)
+            pre = np.array(pre)
+        with run_log.phase('eval_metrics'):
+            pre = np.delete(pre, -1, axis=1)
+            engine.add(data, pre, test_user_id[start_index:end_index])
+    metrics = engine.result()
+    # the second cut-off (10 of the default 5,10,20) is the one the grid compares
+    kj = engine.topK[min(1, len(engine.topK) - 1)]
+    hr, ndcg = metrics['HR@%d' % kj], metrics['NDCG@%d' % kj]
+    print("HR@%d:" % kj, hr, "NDCG@%d:" % kj, ndcg)
+    run_log.log('evaluate', metrics=metrics, users=len(user_features), phases=run_log.take_phases())
     # For automation, you might return these metrics
-    return np.mean(recall100), np.mean(ndcg100)
+    return hr, ndcg
+
+def run_experiment_tf2(args, data, random_seed=2019):
+    global deep
+    import_tf()
+    tf.random.set_seed(random_seed)
+    deep = ENSFM_tf2.ENSFMModule(data.item_map_list, data.user_field_M, data.item_field_M, args.embed_size, data.max_positive_len, args)
+    dataset = ENSFM_tf2.make_dataset(data, args.batch_size, random_seed)
+    if args.verbose > 0:
+        print("Initial evaluation:")
+        evaluate()
+    for epoch in range(args.epochs):
+        print("Epoch:", epoch)
+        start_t = _writeline_and_time('\tUpdating...')
+        ll = 0
+        batches = iter(dataset)
+        while True:
+            with run_log.phase('data_prep'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            with run_log.phase('train_step'):
+                deep.train_step(batch[0], batch[1], args.dropout)
+            ll += 1
+        epoch_time = time.time() - start_t
+        print('\r\tUpdating: time=%.2f, steps/sec=%.2f' % (epoch_time, ll / epoch_time))
+        log_epoch(epoch, ll, epoch_time)
+        if args.verbose > 0 and epoch % args.verbose == 0:
+            evaluate()
+    print("Final evaluation:")
+    return evaluate()
 
-def run_experiment(args, data, random_seed=2019):
-    # Build a new graph for each experiment run
-    with tf.Graph().as_default():
+def run_experiment_eals(args, data, random_seed=2019):
+    global deep
+    deep = ENSFM_eals.ENSFMSolver(data, args.embed_size, args, random_seed)
+    if args.verbose > 0:
+        print("Initial evaluation:")
+        evaluate()
+    for epoch in range(args.epochs):
+        print("Epoch:", epoch)
+        start_t = _writeline_and_time('\tUpdating...')
+        with run_log.phase('solver'):
+            loss = deep.epoch()
+        print('\r\tUpdating: time=%.2f, loss=%.4f' % (time.time() - start_t, loss[0]))
+        log_epoch(epoch, 1, time.time() - start_t, loss=loss[0])
+        if args.verbose > 0 and epoch % args.verbose == 0:
+            evaluate()
+    print("Final evaluation:")
+    return evaluate()
+
+# arguments that are fed at run time or only used outside the graph: trials that differ
+# only in these reuse the graph, optimizer and session of the previous trial
+TRIAL_ARGS = ['lr', 'dropout', 'negative_weight', 'epochs', 'verbose', 'topK', 'cache_items', 'check_scores', 'check_reuse', 'stack']
+sess = None
+_experiment = None
+# telemetry sinks; __main__ replaces them with ones that write the run log and trace
+run_log = Telemetry.RunLog()
+profiler = Telemetry.StepProfiler(None, None)
+
+def log_epoch(epoch, steps, epoch_time, **fields):
+    # examples are training users: one row of user_train each
+    examples = len(data.user_train) if args.optimizer == 'eals' else steps * args.batch_size
+    record = run_log.log('epoch', epoch=epoch, steps=steps, examples=examples, examples_per_sec=examples / epoch_time,
+                         phases=run_log.take_phases(), **fields)
+    print('\texamples/sec=%.0f, peak RSS=%.0fMB' % (record['examples_per_sec'], record['peak_rss_mb']))
+
+def _experiment_key(args, data, random_seed):
+    return {name: value for name, value in vars(args).items() if name not in TRIAL_ARGS}, random_seed, id(data)
+
+def _build_experiment(args, data, random_seed):
+    global sess, deep, train_op1, learning_rate, _experiment
+    import_tf()
+    if sess is not None:
+        sess.close()
+    graph = tf.Graph()
+    with graph.as_default():
         tf.compat.v1.set_random_seed(random_seed)
         session_conf = tf.compat.v1.ConfigProto()
         session_conf.gpu_options.allow_growth = True
-        global sess, deep, train_op1  # make these global so evaluate() and train_step1() can access them
         sess = tf.compat.v1.Session(config=session_conf)
-        with sess.as_default():
-            deep = ENSFM(data.item_map_list, data.user_field_M, data.item_field_M, args.embed_size, data.max_positive_len, args)
-            deep._build_graph()
-            train_op1 = tf.compat.v1.train.AdagradOptimizer(learning_rate=args.lr, initial_accumulator_value=1e-8).minimize(deep.loss)
-            sess.run(tf.compat.v1.global_variables_initializer())
+        deep = ENSFM(data.item_map_list, data.user_field_M, data.item_field_M, args.embed_size, data.max_positive_len, args)
+        # fed when the iterator is initialized, so a trial can start at any epoch's shuffle
+        shuffle_seed = tf.compat.v1.placeholder(tf.int64, [], name="shuffle_seed")
+        iterator_init, iterator_feed, inputs = None, None, None
+        if args.positives == 'ragged':
+            iterator_init, iterator_feed, inputs = InputPipeline.make_ragged_train_iterator(data, args.batch_size, shuffle_seed)
+        elif args.input_pipeline == 'tfdata':
+            iterator_init, iterator_feed, inputs = InputPipeline.make_train_iterator(data, args.batch_size, shuffle_seed)
+        deep._build_graph(inputs)
+        learning_rate = tf.compat.v1.placeholder_with_default(float(args.lr), [], name="learning_rate")
+        minimize = tf.compat.v1.train.AdagradOptimizer(learning_rate=learning_rate, initial_accumulator_value=1e-8).minimize(deep.loss)
+        # every step moves on to the next dropout masks
+        with tf.control_dependencies([minimize]):
+            train_op1 = deep.dropout_step.assign_add(1)
+        variables = tf.compat.v1.global_variables()
+        sess.run(tf.compat.v1.global_variables_initializer())
+        # every trial starts from these values, like a fresh graph seeded with random_seed
+        initial_values = sess.run(variables)
+    _experiment = (_experiment_key(args, data, random_seed), variables, initial_values, iterator_init, iterator_feed, shuffle_seed, inputs)
+
+def run_experiment(args, data, random_seed=2019, checkpoint_dir=None):
+    '''
+    Train one config for args.epochs epochs and evaluate it
+    :param checkpoint_dir: if given, continue from the latest checkpoint in it (if any) up to
+                           args.epochs and leave a checkpoint of the last epoch there, so a
+                           search scheduler can extend the training budget of a config later
+    :return: (HR@10, NDCG@10) after the last epoch
+    '''
+    if not args.use_graph:
+        if checkpoint_dir is not None:
+            raise ValueError('checkpoints are only supported by the graph engine with adagrad')
+        if args.optimizer == 'eals':
+            return run_experiment_eals(args, data, random_seed)
+        return run_experiment_tf2(args, data, random_seed)
+    if _experiment is None or _experiment[0] != _experiment_key(args, data, random_seed):
+        _build_experiment(args, data, random_seed)
+    else:
+        print("reusing the graph of the previous experiment")
+    _, variables, initial_values, iterator_init, iterator_feed, shuffle_seed, inputs = _experiment
+    with sess.graph.as_default(), sess.as_default():
+        for v, value in zip(variables, initial_values):
+            v.load(value, sess)
+        checkpointer = Checkpoint.Checkpointer(checkpoint_dir, keep=1) if checkpoint_dir else None
+        start_epoch = 0
+        if checkpointer is not None and checkpointer.latest() is not None:
+            start_epoch = Checkpoint.read_epoch(checkpointer.latest()) + 1
+        if inputs is not None:
+            iterator_feed[shuffle_seed] = random_seed + start_epoch
+            sess.run(iterator_init, iterator_feed)
+        if start_epoch > 0:
+            Checkpoint.restore(sess, checkpointer.latest())
+            print('resume from', checkpointer.latest())
+        if args.check_scores:
+            check_scores()
+        if start_epoch == 0 and args.verbose > 0:
             print("Initial evaluation:")
             evaluate()
-            for epoch in range(args.epochs):
-                print("Epoch:", epoch)
-                start_t = _writeline_and_time('\tUpdating...')
-                shuffle_indices = np.random.permutation(np.arange(len(data.user_train)))
-                data.user_train = data.user_train[shuffle_indices]
-                data.item_train = data.item_train[shuffle_indices]
-                ll = int(len(data.user_train) / args.batch_size)
-                for batch_num in range(ll):
-                    start_index = batch_num * args.batch_size
-                    end_index = min((batch_num + 1) * args.batch_size, len(data.user_train))
-                    u_batch = data.user_train[start_index:end_index]
-                    i_batch = data.item_train[start_index:end_index]
+        for epoch in range(start_epoch, args.epochs):
+            print("Epoch:", epoch)
+            start_t = _writeline_and_time('\tUpdating...')
+            if inputs is None:
+                with run_log.phase('data_prep'):
+                    shuffle_indices = np.random.permutation(np.arange(len(data.user_train)))
+                    data.user_train = data.user_train[shuffle_indices]
+                    data.item_train = data.item_train[shuffle_indices]
+            ll = int(len(data.user_train) / args.batch_size)
+            run_time = 0.0
+            u_batch, i_batch = None, None
+            for batch_num in range(ll):
+                # with the tf.data iterator, data preparation happens inside sess.run
+                if inputs is None:
+                    with run_log.phase('data_prep'):
+                        start_index = batch_num * args.batch_size
+                        end_index = min((batch_num + 1) * args.batch_size, len(data.user_train))
+                        u_batch = data.user_train[start_index:end_index]
+                        i_batch = data.item_train[start_index:end_index]
+                profiler.step((epoch - start_epoch) * ll + batch_num)
+                run_t = time.time()
+                with run_log.phase('sess_run'):
                     train_step1(u_batch, i_batch, args)
-                print('\r\tUpdating: time=%.2f' % (time.time() - start_t))
-                if epoch % args.verbose == 0:
-                    evaluate()
-            print("Final evaluation:")
-            final_hr, final_ndcg = evaluate()
+                run_time += time.time() - run_t
+            epoch_time = time.time() - start_t
+            print('\r\tUpdating: time=%.2f, steps/sec=%.2f, host ms/step=%.3f'
+                  % (epoch_time, ll / epoch_time, 1000 * (epoch_time - run_time) / max(ll, 1)))
+            log_epoch(epoch, ll, epoch_time)
+            if args.verbose > 0 and epoch % args.verbose == 0:
+                evaluate()
+        profiler.close()
+        if checkpointer is not None and args.epochs > start_epoch:
+            checkpointer.save(sess, args.epochs - 1)
+            checkpointer.wait()
+        print("Final evaluation:")
+        final_hr, final_ndcg = evaluate()
     return final_hr, final_ndcg
 
+def check_reuse(args, data, random_seed):
+    '''
+    Run a trial, then a second one with another dropout on the reused graph, then the second one
+    again on a fresh graph: both runs of the second trial must give the same metrics
+    '''
+    global _experiment
+    trial = copy.copy(args)
+    trial.epochs = 2
+    trial.dropout = 0.5
+    run_experiment(trial, data, random_seed)
+    trial.dropout = 0.7
+    reused = run_experiment(trial, data, random_seed)
+    _experiment = None
+    fresh = run_experiment(trial, data, random_seed)
+    np.testing.assert_allclose(reused, fresh, rtol=1e-6)
+    print("reused graph matches a fresh graph: HR %.6f, NDCG %.6f" % fresh)
+
 if __name__ == '__main__':
     np.random.seed(2019)
     random_seed = 2019
     args = parse_args()
     
     # Choose dataset path based on argument
-    if args.dataset == 'lastfm':
-        print('load lastfm data')
-        DATA_ROOT = '../data/lastfm'
-    elif args.dataset == 'frappe':
-        print('load frappe data')
-        DATA_ROOT = '../data/frappe'
-    elif args.dataset == 'ml-1m':
-        print('load ml-1m data')
-        DATA_ROOT = '../data/ml-1m'
-    elif args.dataset == 'yelp2018':
-        print('load yelp data')
-        DATA_ROOT = '../data/yelp2018'
-    elif args.dataset == 'amazonbook':
-        print('load amazon book data')
-        DATA_ROOT = '../data/amzbook'
+    DATA_ROOT = DATA.get_data_root(args.dataset)
 
     # Open a file to record results if needed
     f1 = open(os.path.join(DATA_ROOT, 'ENSFM_hyperparam_results.txt'), 'w')
-    data = DATA.LoadData(DATA_ROOT)
+    data = DATA.LoadData(DATA_ROOT, pad_positives=args.positives == 'padded')
+    run_log = Telemetry.RunLog(args.run_log or Telemetry.default_path(DATA_ROOT, 'ENSFM_light'), args)
+    profiler = Telemetry.StepProfiler(args.profile_steps, args.profile_dir or os.path.join(DATA_ROOT, 'runs', 'profile'))
+    print('run log:', run_log.path)
     
     # Define a hyperparameter grid (you can expand or modify these lists)
     lr_values = [0.005, 0.01, 0.02, 0.05] #[0.005, 0.01, 0.02, 0.05]
@@ -261,20 +535,43 @@ if __name__ == '__main__':
     neg_weight_values = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0]
     
     results = []
-    # Loop over the grid and run experiments
-    for lr, dropout, neg_weight in itertools.product(lr_values, dropout_values, neg_weight_values):
-        print("Running experiment with lr={}, dropout_keep_prob={}, negative_weight={}".format(lr, dropout, neg_weight))
-        f1.write("lr={}, dropout={}, neg_weight={}\n".format(lr, dropout, neg_weight))
-        # Update hyperparameters in args
-        args.lr = lr
-        args.dropout = dropout
-        args.negative_weight = neg_weight
-        # For quick testing during search, you might use fewer epochs
+    import_tf()
+    if args.check_reuse:
+        check_reuse(args, data, random_seed)
+    if args.stack > 1:
+        # configs that share lr only differ in dropout and negative_weight: train them args.stack at a time
         args.epochs = 50
-        hr, ndcg = run_experiment(args, data, random_seed)
-        results.append(((lr, dropout, neg_weight), (hr, ndcg)))
-        f1.write("Final HR@10: {}  NDCG@10: {}\n\n".format(hr, ndcg))
-        f1.flush()
+        for lr in lr_values:
+            args.lr = lr
+            combos = list(itertools.product(dropout_values, neg_weight_values))
+            for start in range(0, len(combos), args.stack):
+                configs = combos[start:start + args.stack]
+                print("Running experiments with lr={}, (dropout_keep_prob, negative_weight)={}".format(lr, configs))
+                metrics = ENSFM_stack.run_experiments(args, data, configs, random_seed)
+                for (dropout, neg_weight), (hr, ndcg) in zip(configs, metrics):
+                    results.append(((lr, dropout, neg_weight), (hr, ndcg)))
+                    run_log.log('experiment', config={'lr': lr, 'dropout': dropout, 'negative_weight': neg_weight},
+                                metrics={'HR@10': hr, 'NDCG@10': ndcg})
+                    f1.write("lr={}, dropout={}, neg_weight={}\n".format(lr, dropout, neg_weight))
+                    f1.write("Final HR@10: {}  NDCG@10: {}\n\n".format(hr, ndcg))
+                f1.flush()
+    else:
+        # Loop over the grid and run experiments
+        for lr, dropout, neg_weight in itertools.product(lr_values, dropout_values, neg_weight_values):
+            print("Running experiment with lr={}, dropout_keep_prob={}, negative_weight={}".format(lr, dropout, neg_weight))
+            f1.write("lr={}, dropout={}, neg_weight={}\n".format(lr, dropout, neg_weight))
+            # Update hyperparameters in args
+            args.lr = lr
+            args.dropout = dropout
+            args.negative_weight = neg_weight
+            # For quick testing during search, you might use fewer epochs
+            args.epochs = 50
+            hr, ndcg = run_experiment(args, data, random_seed)
+            results.append(((lr, dropout, neg_weight), (hr, ndcg)))
+            run_log.log('experiment', config={'lr': lr, 'dropout': dropout, 'negative_weight': neg_weight},
+                        metrics={'HR@10': hr, 'NDCG@10': ndcg})
+            f1.write("Final HR@10: {}  NDCG@10: {}\n\n".format(hr, ndcg))
+            f1.flush()
     
     print("Hyperparameter search complete. Results:")
     for combo, metrics in results:
@@ -290,3 +587,4 @@ if __name__ == '__main__':
         f1.write(line)
     
     f1.close()
+    run_log.close()
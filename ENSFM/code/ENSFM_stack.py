@@ -0,0 +1,219 @@
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+import InputPipeline
+import Metrics
+
+
+class ENSFMStack:
+    '''
+    K independent copies of the ENSFM model (ENSFM_light.ENSFM) in one graph, one per
+    (dropout keep_prob, negative_weight) config, trained on the same batches.
+    Every per-config tensor has the config axis first ([K, batch, d+2], [K, items, d+2], ...)
+    so the towers, the gram loss and the scores are batched matmuls. The embedding tables
+    keep their rows first ([rows, K, d]) so a lookup is still a row gather and their
+    Adagrad updates stay sparse. The copies share no variables and the loss is the sum of
+    their losses, so one Adagrad step trains each copy exactly as a run of its own would
+    (all configs of a stack share the learning rate).
+    Uses the gram loss and the gemm scoring path.
+    '''
+
+    def __init__(self, item_attribute, user_field_M, item_field_M, embedding_size, max_item_pu, args, negative_weights):
+        self.embedding_size = embedding_size
+        self.max_item_pu = max_item_pu
+        self.user_field_M = user_field_M
+        self.item_field_M = item_field_M
+        self.n_configs = len(negative_weights)
+        self.weight1 = tf.constant(negative_weights, dtype=tf.float32, name="negative_weights")
+        self.item_attribute = item_attribute
+        self.lambda_bilinear = args.lambda_bilinear
+        self.reg_mode = args.reg_mode
+        self.ragged_positives = args.positives == 'ragged'
+
+    def _create_placeholders(self, inputs=None):
+        if inputs is None:
+            self.input_u = tf.compat.v1.placeholder(tf.int32, [None, None], name="input_u_feature")
+            if self.ragged_positives:
+                self.input_pos_row = tf.compat.v1.placeholder(tf.int32, [None], name="input_pos_row")
+                self.input_pos_item = tf.compat.v1.placeholder(tf.int32, [None], name="input_pos_item")
+            else:
+                self.input_ur = tf.compat.v1.placeholder(tf.int32, [None, self.max_item_pu], name="input_ur")
+        else:
+            self.input_u = tf.compat.v1.placeholder_with_default(inputs[0], [None, None], name="input_u_feature")
+            if self.ragged_positives:
+                self.input_pos_row = tf.compat.v1.placeholder_with_default(inputs[1], [None], name="input_pos_row")
+                self.input_pos_item = tf.compat.v1.placeholder_with_default(inputs[2], [None], name="input_pos_item")
+            else:
+                self.input_ur = tf.compat.v1.placeholder_with_default(inputs[1], [None, self.max_item_pu], name="input_ur")
+        # one keep_prob per config
+        self.dropout_keep_prob = tf.compat.v1.placeholder(tf.float32, [self.n_configs], name="dropout_keep_prob")
+
+    def _create_variables(self):
+        K, d = self.n_configs, self.embedding_size
+        self.uidW = tf.Variable(tf.random.truncated_normal(shape=[self.user_field_M, K, d], mean=0.0, stddev=0.01), dtype=tf.float32, name="uidW")
+        self.iidW = tf.Variable(tf.random.truncated_normal(shape=[self.item_field_M+1, K, d], mean=0.0, stddev=0.01), dtype=tf.float32, name="iidW")
+        self.H_i = tf.Variable(tf.constant(0.01, shape=[K, d, 1]), name="hi")
+        self.H_s = tf.Variable(tf.constant(0.01, shape=[K, d, 1]), name="hs")
+        self.u_bias = tf.Variable(tf.random.truncated_normal(shape=[self.user_field_M, K], mean=0.0, stddev=0.01), dtype=tf.float32, name="u_bias")
+        self.i_bias = tf.Variable(tf.random.truncated_normal(shape=[self.item_field_M, K], mean=0.0, stddev=0.01), dtype=tf.float32, name="i_bias")
+        self.bias = tf.Variable(tf.zeros([K]), name='bias')
+
+    def _dropout(self, x):
+        # tf.nn.dropout takes a single rate; this is the same inverted dropout with a rate per config
+        keep_prob = tf.reshape(self.dropout_keep_prob, [-1, 1, 1])
+        return x * tf.floor(keep_prob + tf.random.uniform(tf.shape(x))) / keep_prob
+
+    def _create_vectors(self):
+        K = self.n_configs
+        user_feature_emb = tf.nn.embedding_lookup(self.uidW, self.input_u)              # [batch, fields, K, d]
+        summed_user_emb = tf.reduce_sum(user_feature_emb, 1)
+        user_cross = 0.5 * (tf.square(summed_user_emb) - tf.reduce_sum(tf.square(user_feature_emb), 1))
+        summed_user_emb = tf.transpose(summed_user_emb, [1, 0, 2])                      # [K, batch, d]
+        user_cross = tf.transpose(user_cross, [1, 0, 2])
+
+        self.H_i_drop = self._dropout(self.H_i)
+        self.H_s_drop = self._dropout(self.H_s)
+
+        all_item_feature_emb = tf.nn.embedding_lookup(self.iidW, self.item_attribute)   # [items, fields, K, d]
+        summed_all_item_emb = tf.reduce_sum(all_item_feature_emb, 1)
+        item_cross = 0.5 * (tf.square(summed_all_item_emb) - tf.reduce_sum(tf.square(all_item_feature_emb), 1))
+        summed_all_item_emb = tf.transpose(summed_all_item_emb, [1, 0, 2])              # [K, items, d]
+        item_cross = tf.transpose(item_cross, [1, 0, 2])
+
+        user_cross_score = tf.matmul(user_cross, self.H_s_drop)
+        item_cross_score = tf.matmul(item_cross, self.H_s_drop)
+        user_bias = tf.transpose(tf.reduce_sum(tf.nn.embedding_lookup(self.u_bias, self.input_u), 1))[:, :, None]
+        item_bias = tf.transpose(tf.reduce_sum(tf.nn.embedding_lookup(self.i_bias, self.item_attribute), 1))[:, :, None]
+
+        I = tf.ones(shape=(K, tf.shape(self.input_u)[0], 1))
+        self.p_emb = tf.concat([summed_user_emb, user_cross_score + user_bias + self.bias[:, None, None], I], 2)
+        I = tf.ones(shape=(K, len(self.item_attribute), 1))
+        self.q_emb = tf.concat([summed_all_item_emb, I, item_cross_score + item_bias], 2)
+        self.H_i_emb = tf.concat([self.H_i_drop, tf.ones([K, 2, 1])], 1)
+
+    def _create_inference(self):
+        if self.ragged_positives:
+            pos_item = tf.gather(self.q_emb, self.input_pos_item, axis=1)
+            self.pos_r = tf.matmul(tf.gather(self.p_emb, self.input_pos_row, axis=1) * pos_item, self.H_i_emb)[:, :, 0]
+            return
+        pos_item = tf.gather(self.q_emb, self.input_ur, axis=1)                         # [K, batch, max_item_pu, d+2]
+        # the last row of item_attribute is the padding item (LoadData.item_bind_M)
+        pos_num_r = tf.cast(tf.not_equal(self.input_ur, len(self.item_attribute) - 1), 'float32')
+        p_weighted = self.p_emb * tf.transpose(self.H_i_emb, [0, 2, 1])
+        self.pos_r = tf.einsum('kac,kabc->kab', p_weighted, pos_item) * pos_num_r
+
+    def _create_loss(self):
+        q_gram = tf.matmul(self.q_emb, self.q_emb, transpose_a=True)                   # [K, d+2, d+2]
+        p_gram = tf.matmul(self.p_emb, self.p_emb, transpose_a=True)
+        h_gram = tf.matmul(self.H_i_emb, self.H_i_emb, transpose_b=True)
+        pos_axes = list(range(1, len(self.pos_r.shape)))
+        self.losses = self.weight1 * tf.reduce_sum(q_gram * p_gram * h_gram, [1, 2])
+        self.losses += tf.reduce_sum((1.0 - tf.reshape(self.weight1, [-1] + [1] * len(pos_axes))) * tf.square(self.pos_r)
+                                     - 2.0 * self.pos_r, pos_axes)
+        if self.reg_mode == 'lazy':
+            user_rows = tf.unique(tf.reshape(self.input_u, [-1]))[0]
+            item_rows = np.unique(self.item_attribute)
+            l2_loss0 = tf.nn.l2_loss(tf.gather(self.uidW, user_rows))
+            l2_loss1 = tf.nn.l2_loss(tf.gather(self.iidW, item_rows))
+        else:
+            l2_loss0 = tf.nn.l2_loss(self.uidW)
+            l2_loss1 = tf.nn.l2_loss(self.iidW)
+        # summed over the configs like the losses, so every copy gets its own regularization gradient
+        self.reg_loss = tf.constant(0.0)
+        if self.lambda_bilinear[0] != 0.0:
+            self.reg_loss += self.lambda_bilinear[0] * l2_loss0
+        if self.lambda_bilinear[1] != 0.0:
+            self.reg_loss += self.lambda_bilinear[1] * l2_loss1
+        self.loss = tf.reduce_sum(self.losses) + self.reg_loss
+
+    def _build_graph(self, inputs=None):
+        self._create_placeholders(inputs)
+        self._create_variables()
+        self._create_vectors()
+        self._create_inference()
+        self._create_loss()
+        # [K, batch, items]
+        self.pre = tf.matmul(self.p_emb * tf.transpose(self.H_i_emb, [0, 2, 1]), self.q_emb, transpose_b=True)
+
+
+def evaluate(sess, model, data, topK, eva_batch=128):
+    '''
+    Score every test user for all configs with one sess.run per batch
+    :return: list of (HR@topK[1], NDCG@topK[1]), one per config
+    '''
+    ones = np.ones(model.n_configs, dtype=np.float32)
+    q_emb, H_i_emb = sess.run([model.q_emb, model.H_i_emb], {model.dropout_keep_prob: ones})
+    engines = [Metrics.TopKMetrics(topK) for _ in range(model.n_configs)]
+    user_features, test_user_id = data.unique_test_users()
+    ll = int(len(user_features) / eva_batch) + 1
+    for batch_num in range(ll):
+        u_batch = user_features[batch_num * eva_batch:(batch_num + 1) * eva_batch]
+        if len(u_batch) == 0:
+            continue
+        pre = sess.run(model.pre, {model.input_u: u_batch, model.dropout_keep_prob: ones,
+                                   model.q_emb: q_emb, model.H_i_emb: H_i_emb})
+        pre = pre[:, :, :-1]
+        user_id = test_user_id[batch_num * eva_batch:(batch_num + 1) * eva_batch]
+        for k in range(model.n_configs):
+            engines[k].add(data, pre[k], user_id)
+    kj = engines[0].topK[min(1, len(engines[0].topK) - 1)]
+    results = [(metrics['HR@%d' % kj], metrics['NDCG@%d' % kj]) for metrics in [engine.result() for engine in engines]]
+    for k, (hr, nd) in enumerate(results):
+        print("\tconfig %d: HR@%d: %s NDCG@%d: %s" % (k, kj, hr, kj, nd))
+    return results
+
+
+def run_experiments(args, data, configs, random_seed=2019):
+    '''
+    Train several configs that share args.lr together in one graph and one Session
+    :param configs: list of (dropout keep_prob, negative_weight)
+    :return: list of (HR@10, NDCG@10) after the last epoch, one per config
+    '''
+    keep_probs = np.array([dropout for dropout, _ in configs], dtype=np.float32)
+    with tf.Graph().as_default():
+        tf.compat.v1.set_random_seed(random_seed)
+        session_conf = tf.compat.v1.ConfigProto()
+        session_conf.gpu_options.allow_growth = True
+        sess = tf.compat.v1.Session(config=session_conf)
+        with sess.as_default():
+            model = ENSFMStack(data.item_map_list, data.user_field_M, data.item_field_M, args.embed_size,
+                               data.max_positive_len, args, [neg_weight for _, neg_weight in configs])
+            inputs = None
+            if args.positives == 'ragged':
+                iterator_init, iterator_feed, inputs = InputPipeline.make_ragged_train_iterator(data, args.batch_size, random_seed)
+            elif args.input_pipeline == 'tfdata':
+                iterator_init, iterator_feed, inputs = InputPipeline.make_train_iterator(data, args.batch_size, random_seed)
+            model._build_graph(inputs)
+            train_op = tf.compat.v1.train.AdagradOptimizer(learning_rate=args.lr, initial_accumulator_value=1e-8).minimize(model.loss)
+            sess.run(tf.compat.v1.global_variables_initializer())
+            if inputs is not None:
+                sess.run(iterator_init, iterator_feed)
+            if args.verbose > 0:
+                print("Initial evaluation:")
+                evaluate(sess, model, data, args.topK)
+            for epoch in range(args.epochs):
+                print("Epoch:", epoch)
+                start_t = time.time()
+                sys.stdout.write('\tUpdating...')
+                sys.stdout.flush()
+                if inputs is None:
+                    shuffle_indices = np.random.permutation(np.arange(len(data.user_train)))
+                    data.user_train = data.user_train[shuffle_indices]
+                    data.item_train = data.item_train[shuffle_indices]
+                ll = int(len(data.user_train) / args.batch_size)
+                for batch_num in range(ll):
+                    feed_dict = {model.dropout_keep_prob: keep_probs}
+                    if inputs is None:
+                        feed_dict[model.input_u] = data.user_train[batch_num * args.batch_size:(batch_num + 1) * args.batch_size]
+                        feed_dict[model.input_ur] = data.item_train[batch_num * args.batch_size:(batch_num + 1) * args.batch_size]
+                    sess.run(train_op, feed_dict)
+                epoch_time = time.time() - start_t
+                print('\r\tUpdating: time=%.2f, steps/sec=%.2f, configs x steps/sec=%.2f'
+                      % (epoch_time, ll / epoch_time, len(configs) * ll / epoch_time))
+                if args.verbose > 0 and epoch % args.verbose == 0:
+                    evaluate(sess, model, data, args.topK)
+            print("Final evaluation:")
+            results = evaluate(sess, model, data, args.topK)
+        sess.close()
+    return results
@@ -0,0 +1,143 @@
+import numpy as np
+import tensorflow as tf
+
+
+class ENSFMModule(tf.Module):
+    '''
+    The ENSFM model of ENSFM.py as a tf.Module with XLA-compiled training and scoring.
+    Uses the gram loss and the gemm scoring path, and applies the same update as
+    tf.compat.v1.train.AdagradOptimizer(initial_accumulator_value=1e-8).
+    '''
+
+    def __init__(self, item_attribute, user_field_M, item_field_M, embedding_size, max_item_pu, args):
+        super().__init__(name='ENSFM')
+        self.embedding_size = embedding_size
+        self.max_item_pu = max_item_pu
+        self.weight1 = args.negative_weight
+        self.lr = args.lr
+        self.lambda_bilinear = args.lambda_bilinear
+        self.item_attribute = tf.constant(item_attribute, dtype=tf.int32)
+        # the last row of item_attribute is the padding item (LoadData.item_bind_M)
+        self.pad_item = len(item_attribute) - 1
+
+        self.uidW = tf.Variable(tf.random.truncated_normal(shape=[user_field_M, embedding_size], mean=0.0, stddev=0.01), dtype=tf.float32, name="uidW")
+        self.iidW = tf.Variable(tf.random.truncated_normal(shape=[item_field_M+1, embedding_size], mean=0.0, stddev=0.01), dtype=tf.float32, name="iidW")
+        self.H_i = tf.Variable(tf.constant(0.01, shape=[embedding_size, 1]), name="hi")
+        self.H_s = tf.Variable(tf.constant(0.01, shape=[embedding_size, 1]), name="hs")
+        self.u_bias = tf.Variable(tf.random.truncated_normal(shape=[user_field_M, 1], mean=0.0, stddev=0.01), dtype=tf.float32, name="u_bias")
+        self.i_bias = tf.Variable(tf.random.truncated_normal(shape=[item_field_M, 1], mean=0.0, stddev=0.01), dtype=tf.float32, name="i_bias")
+        self.bias = tf.Variable(tf.constant(0.0), name='bias')
+        self.params = [self.uidW, self.iidW, self.H_i, self.H_s, self.u_bias, self.i_bias, self.bias]
+        # every step reaches all of these, but only the batch users' rows of uidW and u_bias
+        self.dense_params = [self.iidW, self.H_i, self.H_s, self.i_bias, self.bias]
+        self.accumulators = [tf.Variable(tf.fill(tf.shape(v), 1e-8), trainable=False, name=v.name.split(':')[0] + '/Adagrad')
+                             for v in self.params]
+
+    def assign_from(self, sess):
+        '''
+        Copy the variables of a legacy graph ENSFM (ENSFM.py) into this module
+        :param sess: session holding the legacy variables
+        '''
+        names = ['uidW', 'iidW', 'hi', 'hs', 'u_bias', 'i_bias', 'bias']
+        variables = {v.op.name: v for v in sess.graph.get_collection(tf.compat.v1.GraphKeys.GLOBAL_VARIABLES)}
+        values = sess.run([variables[name] for name in names])
+        for v, value in zip(self.params, values):
+            v.assign(value)
+
+    def _item_tower(self, H_i, H_s):
+        all_item_feature_emb = tf.nn.embedding_lookup(self.iidW, self.item_attribute)
+        summed_all_item_emb = tf.reduce_sum(all_item_feature_emb, 1)
+        item_cross = 0.5 * (tf.square(summed_all_item_emb) - tf.reduce_sum(tf.square(all_item_feature_emb), 1))
+        item_bias = tf.reduce_sum(tf.nn.embedding_lookup(self.i_bias, self.item_attribute), 1)
+        I = tf.ones(shape=(tf.shape(summed_all_item_emb)[0], 1))
+        q_emb = tf.concat([summed_all_item_emb, I, tf.matmul(item_cross, H_s) + item_bias], 1)
+        H_i_emb = tf.concat([H_i, [[1.0]], [[1.0]]], 0)
+        return q_emb, H_i_emb
+
+    def _user_tower(self, input_u, H_s):
+        user_feature_emb = tf.nn.embedding_lookup(self.uidW, input_u)
+        summed_user_emb = tf.reduce_sum(user_feature_emb, 1)
+        user_cross = 0.5 * (tf.square(summed_user_emb) - tf.reduce_sum(tf.square(user_feature_emb), 1))
+        user_bias = tf.reduce_sum(tf.nn.embedding_lookup(self.u_bias, input_u), 1)
+        I = tf.ones(shape=(tf.shape(input_u)[0], 1))
+        return tf.concat([summed_user_emb, tf.matmul(user_cross, H_s) + user_bias + self.bias, I], 1)
+
+    def _loss(self, input_u, input_ur, dropout_keep_prob):
+        H_i = tf.nn.dropout(self.H_i, rate=1.0 - dropout_keep_prob)
+        H_s = tf.nn.dropout(self.H_s, rate=1.0 - dropout_keep_prob)
+        q_emb, H_i_emb = self._item_tower(H_i, H_s)
+        p_emb = self._user_tower(input_u, H_s)
+        pos_num_r = tf.cast(tf.not_equal(input_ur, self.pad_item), tf.float32)
+        pos_item = tf.gather(q_emb, input_ur) * pos_num_r[:, :, None]
+        pos_r = tf.einsum('ac,abc->ab', p_emb * tf.transpose(H_i_emb), pos_item)
+        loss1 = self.weight1 * tf.reduce_sum(
+            tf.matmul(q_emb, q_emb, transpose_a=True) * tf.matmul(p_emb, p_emb, transpose_a=True)
+            * tf.matmul(H_i_emb, H_i_emb, transpose_b=True))
+        loss1 += tf.reduce_sum((1.0 - self.weight1) * tf.square(pos_r) - 2.0 * pos_r)
+        reg_loss = self.lambda_bilinear[0] * tf.nn.l2_loss(self.uidW) + self.lambda_bilinear[1] * tf.nn.l2_loss(self.iidW)
+        return loss1 + reg_loss, loss1, reg_loss
+
+    @tf.function(jit_compile=True)
+    def loss(self, input_u, input_ur, dropout_keep_prob):
+        return self._loss(input_u, input_ur, dropout_keep_prob)
+
+    def _apply_gradients(self, grads):
+        for v, accumulator, grad in zip(self.params, self.accumulators, grads):
+            grad = tf.convert_to_tensor(grad)
+            accumulator.assign_add(tf.square(grad))
+            v.assign_sub(self.lr * grad / tf.sqrt(accumulator))
+
+    @tf.function(jit_compile=True)
+    def train_step(self, input_u, input_ur, dropout_keep_prob):
+        with tf.GradientTape() as tape:
+            loss, loss1, reg_loss = self._loss(input_u, input_ur, dropout_keep_prob)
+        self._apply_gradients(tape.gradient(loss, self.params))
+        return loss, loss1, reg_loss
+
+    @tf.function(jit_compile=True)
+    def sparse_gradients(self, input_u, input_ur, dropout_keep_prob):
+        '''
+        Gradients of the data term alone, for summing over data-parallel replicas
+        :return: (gradients of dense_params, [batch * user fields, embedding size + 1] gradients of the
+                  uidW and u_bias rows of input_u.ravel(), loss, loss1, reg_loss)
+        '''
+        with tf.GradientTape() as tape:
+            loss, loss1, reg_loss = self._loss(input_u, input_ur, dropout_keep_prob)
+        grads = tape.gradient(loss1, self.dense_params + [self.uidW, self.u_bias])
+        # the lookups of input_u give the user tables IndexedSlices gradients over its entries
+        user_grads = tf.concat([grads[-2].values, grads[-1].values], 1)
+        return [tf.convert_to_tensor(grad) for grad in grads[:-2]], user_grads, loss, loss1, reg_loss
+
+    @tf.function(jit_compile=True)
+    def apply_sparse_gradients(self, grads, rows, user_grads):
+        '''
+        Adagrad step from summed data-term gradients, see sparse_gradients; adds the gradient of the
+        regularizer once
+        :param grads: gradients of dense_params
+        :param rows: uidW/u_bias row of every row of user_grads, repeated rows are summed
+        :param user_grads: [len(rows), embedding size + 1] uidW row gradients followed by the u_bias one
+        '''
+        user_grads = tf.scatter_nd(rows[:, None], user_grads, [tf.shape(self.uidW)[0], self.embedding_size + 1])
+        uidW_grad = user_grads[:, :self.embedding_size] + self.lambda_bilinear[0] * self.uidW
+        iidW_grad = grads[0] + self.lambda_bilinear[1] * self.iidW
+        self._apply_gradients([uidW_grad, iidW_grad, grads[1], grads[2], user_grads[:, self.embedding_size:], grads[3], grads[4]])
+
+    @tf.function(jit_compile=True)
+    def item_tower(self):
+        return self._item_tower(self.H_i, self.H_s)
+
+    @tf.function(jit_compile=True)
+    def score(self, input_u, q_emb, H_i_emb):
+        p_emb = self._user_tower(input_u, self.H_s)
+        return tf.matmul(p_emb * tf.transpose(H_i_emb), q_emb, transpose_b=True)
+
+
+def make_dataset(data, batch_size, seed=None):
+    '''
+    Eager tf.data pipeline over the padded LoadData training arrays
+    :return: dataset yielding int(len(user_train) / batch_size) (user batch, positive item batch) pairs per pass
+    '''
+    dataset = tf.data.Dataset.from_tensor_slices((data.user_train.astype(np.int32), data.item_train.astype(np.int32)))
+    dataset = dataset.shuffle(len(data.user_train), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    return dataset.prefetch(tf.data.AUTOTUNE)
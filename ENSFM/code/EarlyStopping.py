@@ -0,0 +1,65 @@
+class EarlyStopping(object):
+    '''
+    Decide when to evaluate and when to stop, based on one metric returned by evaluate().
+    fixed schedule: evaluate every `interval` epochs (epoch % interval == 0).
+    adaptive schedule: start with `interval` epochs between evaluations and halve it (down to 1)
+    whenever the metric improved by less than `tol` (relative) since the previous evaluation,
+    so evaluations are rare while the metric still climbs and frequent near convergence.
+    Training stops once the metric has not improved by more than `min_delta` for `patience`
+    epochs (patience 0 never stops).
+    '''
+
+    def __init__(self, metric, patience=0, min_delta=0.0, schedule='fixed', interval=10, tol=0.01):
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.schedule = schedule
+        self.interval = interval
+        self.tol = tol
+        self.next_eval = 0
+        self.last = None
+        self.best = None
+        self.best_epoch = None
+        self.stop = False
+
+    def should_evaluate(self, epoch):
+        if self.schedule == 'fixed':
+            return epoch % self.interval == 0
+        return epoch >= self.next_eval
+
+    def update(self, epoch, metrics):
+        '''
+        :param metrics: dict returned by evaluate()
+        :return: True if this is the best value so far
+        '''
+        value = metrics[self.metric]
+        if self.schedule == 'adaptive':
+            if self.last is not None and value - self.last < self.tol * abs(self.last):
+                self.interval = max(1, self.interval // 2)
+            self.next_eval = epoch + self.interval
+        self.last = value
+        improved = self.best is None or value > self.best + self.min_delta
+        if improved:
+            self.best = value
+            self.best_epoch = epoch
+        elif self.patience > 0 and epoch - self.best_epoch >= self.patience:
+            self.stop = True
+        return improved
+
+    def state(self):
+        '''
+        :return: [interval, next_eval, best_epoch, last, best] as floats (nan for None), for a
+                 checkpoint's extra arrays, see load_state
+        '''
+        return [float('nan') if value is None else float(value)
+                for value in [self.interval, self.next_eval, self.best_epoch, self.last, self.best]]
+
+    def load_state(self, state):
+        '''
+        Continue from the evaluations of an earlier run, so a resumed run neither takes its first
+        evaluation for a new best nor restarts its patience
+        :param state: output of state()
+        '''
+        values = [None if value != value else float(value) for value in state]
+        self.interval, self.next_eval, self.best_epoch = [None if value is None else int(value) for value in values[:3]]
+        self.last, self.best = values[3:]
@@ -0,0 +1,86 @@
+import numpy as np
+
+# Fold-in of users who were not trained on: with the items fixed, the whole-data ENSFM loss of
+# one user is quadratic in z = p_emb * H_i_emb^T,
+#   L(z) = w z^T G z + sum over the user's items v of (1 - w) (z . q_v)^2 - 2 z . q_v
+# with G = q_emb^T q_emb the item Gram matrix of the training loss (q_gram) and w the negative
+# weight. The last entry of z is the constant 1, so the optimum of the other d+1 entries x is one
+# linear system per user. A ridge term reg * |x - x0|^2 pulls x towards x0, the p_emb the model
+# builds from the user's features, so a user with few interactions stays close to it.
+# The system matrix is M + (1 - w) U^T U, with M = w G + reg I the same for every user and U the
+# user's n item rows, so M^-1 is cached and a user with few items only needs the Woodbury update:
+# an [n, n] solve instead of a [d+1, d+1] one. Users are batched in power of two buckets of n,
+# zero-padded to the longest n of the bucket; buckets with n >= d+1 solve the full system.
+#
+# reg is an absolute weight next to w G, so its best value depends on the model; check it with
+# bench_foldin.py on held-out users. With a small reg the few items of a user outweigh its
+# features and fold-in ranks below the features-only vector (frappe, eals, 1000 held-out users:
+# NDCG@10 0.30-0.45 at reg 0.01-0.1 against 0.47-0.48 from features). The default reg = 3 was
+# within 0.001 of features-only or above it on HR and NDCG at negative_weight 0.01 and 0.05
+# there. Fold-in adds little where the features already identify the user, as in frappe, whose
+# user rows are user contexts; it is for users the model has never seen, not a refresh of users
+# it was trained on.
+
+
+class FoldIn(object):
+    '''
+    Closed-form user representations from features and interactions over a ServingModel
+    '''
+
+    def __init__(self, model, negative_weight=None, reg=3.0):
+        '''
+        :param model: ServingModel
+        :param negative_weight: weight of non-observed data the model was trained with (default: from the artifact)
+        :param reg: ridge weight towards the feature-based user vector
+        '''
+        self.model = model
+        self.weight1 = model.manifest.get('negative_weight') if negative_weight is None else negative_weight
+        if self.weight1 is None:
+            raise ValueError('the artifact does not record its negative_weight, pass it explicitly')
+        self.reg = reg
+        self.q = np.asarray(model.q_emb, dtype=np.float64)
+        self.H = np.asarray(model.H_i_emb, dtype=np.float64)[:, 0]
+        self.D = len(self.H) - 1
+        self.gram = self.q.T.dot(self.q)
+        self.M = self.weight1 * self.gram[:self.D, :self.D] + reg * np.eye(self.D)
+        self.M_inv = np.linalg.inv(self.M)
+
+    def fold_in(self, input_u, items):
+        '''
+        :param input_u: [batch, user fields] user feature ids
+        :param items: list of item id arrays, the items every user interacted with
+        :return: p_emb [batch, d+2] float32, to be scored like ServingModel.user_tower output
+        '''
+        x0 = (self.model.user_tower(input_u) * self.H)[:, :self.D].astype(np.float64)
+        lengths = np.array([len(v) for v in items])
+        x = np.empty_like(x0)
+        # users with similar numbers of items are padded together, in power of two buckets
+        buckets = np.ceil(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+        for bucket in np.unique(buckets):
+            rows = np.flatnonzero(buckets == bucket)
+            x[rows] = self._solve(x0[rows], [items[row] for row in rows], lengths[rows])
+        z = np.hstack([x, np.ones((len(x), 1))])
+        # back from z to p_emb; an entry with H_i = 0 does not change any score
+        H = np.where(self.H == 0, 1.0, self.H)
+        return (z / H * (self.H != 0)).astype(np.float32)
+
+    def _solve(self, x0, items, lengths):
+        w, s = self.weight1, 1.0 - self.weight1
+        L = max(lengths.max(), 1)
+        # item rows of every user, zero-padded to L rows (a zero row adds nothing to the system)
+        U = np.zeros((len(items), L, self.D + 1))
+        if lengths.sum():
+            U[np.arange(L) < lengths[:, None]] = self.q[np.concatenate(items).astype(np.int64)]
+        Ux, u_last = U[:, :, :self.D], U[:, :, self.D]
+        # right-hand side b - A[:, last] + reg * x0 with the fixed last entry of z moved over
+        rhs = Ux.sum(1) - w * self.gram[:self.D, self.D] - s * np.einsum('bld,bl->bd', Ux, u_last) + self.reg * x0
+        if L >= self.D:
+            # many items: the full system is the smaller one
+            A = self.M + s * np.einsum('bld,ble->bde', Ux, Ux)
+            return np.linalg.solve(A, rhs[:, :, None])[:, :, 0]
+        # Woodbury: (M + s U^T U)^-1 r = y - s Y^T (I + s U Y^T)^-1 U y, with y = M^-1 r and Y = U M^-1
+        y = rhs.dot(self.M_inv)
+        Y = Ux.dot(self.M_inv)
+        inner = np.eye(L) + s * np.einsum('bld,bkd->blk', Ux, Y)
+        c = np.linalg.solve(inner, np.einsum('bld,bd->bl', Ux, y)[:, :, None])[:, :, 0]
+        return y - s * np.einsum('bl,bld->bd', c, Y)
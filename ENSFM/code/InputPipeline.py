@@ -0,0 +1,58 @@
+import numpy as np
+import tensorflow as tf
+
+
+def make_train_iterator(data, batch_size, seed=None):
+    '''
+    Shuffle, batch and prefetch the padded LoadData training arrays on tf.data threads.
+    Every pass over the data is reshuffled and yields int(len(user_train) / batch_size)
+    full batches, like the feed_dict loop.
+    :param data: LoadData instance
+    :param batch_size: users per training batch
+    :param seed: shuffle seed (int or int64 scalar tensor fed with the initializer)
+    :return: (initializer op, feed_dict for the initializer, (user batch, positive item batch) tensors)
+    '''
+    user_train = tf.compat.v1.placeholder(tf.int32, data.user_train.shape, name="user_train")
+    item_train = tf.compat.v1.placeholder(tf.int32, data.item_train.shape, name="item_train")
+    dataset = tf.data.Dataset.from_tensor_slices((user_train, item_train))
+    dataset = dataset.shuffle(len(data.user_train), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.repeat()
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+    # the arrays are fed once into the initializer instead of being embedded in the graph
+    feed_dict = {
+        user_train: data.user_train.astype(np.int32),
+        item_train: data.item_train.astype(np.int32),
+    }
+    return iterator.initializer, feed_dict, iterator.get_next()
+
+
+def make_ragged_train_iterator(data, batch_size, seed=None):
+    '''
+    Same as make_train_iterator, but reads the unpadded positives (LoadData.train_indptr /
+    LoadData.train_items) so a batch only carries the interactions its users actually have.
+    :param data: LoadData instance
+    :param batch_size: users per training batch
+    :param seed: shuffle seed (int or int64 scalar tensor fed with the initializer)
+    :return: (initializer op, feed_dict for the initializer,
+              (user batch, batch row of every positive, positive item ids) tensors)
+    '''
+    user_train = tf.compat.v1.placeholder(tf.int32, data.user_train.shape, name="user_train")
+    train_indptr = tf.compat.v1.placeholder(tf.int64, data.train_indptr.shape, name="train_indptr")
+    train_items = tf.compat.v1.placeholder(tf.int32, data.train_items.shape, name="train_items")
+    positives = tf.RaggedTensor.from_row_splits(train_items, train_indptr)
+    dataset = tf.data.Dataset.from_tensor_slices((user_train, positives))
+    dataset = dataset.shuffle(len(data.user_train), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.map(lambda u, pos: (u, tf.cast(pos.value_rowids(), tf.int32), pos.flat_values),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.repeat()
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+    feed_dict = {
+        user_train: data.user_train.astype(np.int32),
+        train_indptr: data.train_indptr,
+        train_items: data.train_items,
+    }
+    return iterator.initializer, feed_dict, iterator.get_next()
@@ -1,9 +1,33 @@
 import numpy as np
 import os
+import pickle
 import scipy.sparse
+
+# directory of every dataset name the scripts accept for --dataset
+DATA_ROOTS = {
+    'lastfm': '../data/lastfm',
+    'frappe': '../data/frappe',
+    'ml-1m': '../data/ml-1m',
+    'yelp2018': '../data/yelp2018',
+    'amazonbook': '../data/amzbook',
+    'History': '/media/leo/Huy/Project/CARS/AMZ/History',
+    'Genre Fiction': '/media/leo/Huy/Project/CARS/AMZ/Genre Fiction',
+    'Arts & Photography': '/media/leo/Huy/Project/CARS/AMZ/Arts & Photography',
+}
+
+def get_data_root(dataset):
+    '''
+    :param dataset: dataset name, a key of DATA_ROOTS
+    :return: directory holding the dataset's train.csv and test.csv
+    '''
+    if dataset not in DATA_ROOTS:
+        raise ValueError('unknown dataset %r, expected one of: %s' % (dataset, ', '.join(DATA_ROOTS)))
+    print('load %s data' % dataset)
+    return DATA_ROOTS[dataset]
+
 class LoadData(object):
 
-    def __init__(self, DATA_ROOT):
+    def __init__(self, DATA_ROOT, pad_positives=True):
         self.trainfile = os.path.join(DATA_ROOT, 'train.csv')
         self.testfile = os.path.join(DATA_ROOT, 'test.csv')
         self.user_field_M, self.item_field_M = self.get_length()
@@ -20,10 +44,108 @@ class LoadData(object):
         self.item_map_list.append([int(feature) for feature in self.item_map[0].strip().split('-')[0:]])
         self.user_positive_list = self.get_positive_list(self.trainfile)  # userID positive itemID
         self.Train_data, self.Test_data = self.construct_data()
-        self.user_train, self.item_train = self.get_train_instances()
+        self.user_train, self.item_train = self.get_train_instances(pad_positives)
         self.user_test=self.get_test()
 
 
+    # arrays a cache keeps as .npy files, so processes can memory-map one shared copy
+    CACHE_ARRAYS = ['user_train', 'item_train', 'train_indptr', 'train_items', 'item_map_list', 'user_test',
+                    'Train_data.data', 'Train_data.indices', 'Train_data.indptr',
+                    'Test_data.data', 'Test_data.indices', 'Test_data.indptr']
+    CACHE_FIELDS = ['user_field_M', 'item_field_M', 'item_bind_M', 'user_bind_M', 'max_positive_len', 'binded_users']
+
+    def save_cache(self, cache_dir):
+        '''
+        Write what training and evaluate() need to cache_dir, see from_cache
+        :param cache_dir: output directory
+        '''
+        os.makedirs(cache_dir, exist_ok=True)
+        arrays = {
+            'user_train': self.user_train,
+            'item_train': self.item_train,
+            'train_indptr': self.train_indptr,
+            'train_items': self.train_items,
+            'item_map_list': np.array(self.item_map_list, dtype=np.int32),
+            'user_test': np.array(self.user_test, dtype=np.int32),
+        }
+        for name in ['Train_data', 'Test_data']:
+            matrix = getattr(self, name)
+            for part in ['data', 'indices', 'indptr']:
+                arrays[name + '.' + part] = getattr(matrix, part)
+        # the old manifest goes first, so an interrupted rewrite leaves no cache that looks valid
+        meta_path = os.path.join(cache_dir, 'meta.pkl')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        for name, value in arrays.items():
+            path = os.path.join(cache_dir, name + '.npy')
+            if value is None:
+                # an array of an older cache (item_train of a padded build) must not outlive it
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            # written next to the old file and renamed over it, so processes that still map the
+            # old file keep reading a complete copy
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, value)
+            os.replace(path + '.tmp', path)
+        meta = {name: getattr(self, name) for name in self.CACHE_FIELDS}
+        meta['sources'] = self.source_stamp(self.trainfile, self.testfile)
+        meta['arrays'] = [name for name, value in arrays.items() if value is not None]
+        with open(meta_path + '.tmp', 'wb') as f:
+            pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    @staticmethod
+    def source_stamp(*files):
+        return [(os.path.abspath(file), os.path.getsize(file), os.path.getmtime(file)) for file in files]
+
+    @classmethod
+    def from_cache(cls, cache_dir, mmap_mode='r'):
+        '''
+        Rebuild a LoadData from save_cache output without parsing the csv files. The arrays
+        are memory-mapped, so every process attaching to the same cache shares one copy.
+        :param cache_dir: directory written by save_cache
+        :param mmap_mode: np.load mmap_mode, None to read the arrays into memory
+        :return: LoadData with the fields training and evaluate() use
+        '''
+        self = cls.__new__(cls)
+        with open(os.path.join(cache_dir, 'meta.pkl'), 'rb') as f:
+            meta = pickle.load(f)
+        for name in self.CACHE_FIELDS:
+            setattr(self, name, meta[name])
+        arrays = {}
+        for name in self.CACHE_ARRAYS:
+            path = os.path.join(cache_dir, name + '.npy')
+            arrays[name] = np.load(path, mmap_mode=mmap_mode) if name in meta['arrays'] else None
+        for name in ['user_train', 'item_train', 'train_indptr', 'train_items', 'item_map_list', 'user_test']:
+            setattr(self, name, arrays[name])
+        for name in ['Train_data', 'Test_data']:
+            setattr(self, name, scipy.sparse.csr_matrix(
+                (arrays[name + '.data'], arrays[name + '.indices'], arrays[name + '.indptr']),
+                shape=(self.user_bind_M, self.item_bind_M), copy=False))
+        return self
+
+    @classmethod
+    def cached(cls, DATA_ROOT, cache_dir=None, pad_positives=True):
+        '''
+        from_cache if cache_dir holds a cache of the current csv files (same path, size and
+        modification time), otherwise parse them and write the cache
+        :param cache_dir: defaults to <DATA_ROOT>/cache
+        '''
+        cache_dir = cache_dir or os.path.join(DATA_ROOT, 'cache')
+        sources = cls.source_stamp(os.path.join(DATA_ROOT, 'train.csv'), os.path.join(DATA_ROOT, 'test.csv'))
+        meta_path = os.path.join(cache_dir, 'meta.pkl')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'rb') as f:
+                meta = pickle.load(f)
+            # caches written before the manifest listed its arrays are rebuilt
+            arrays = meta.get('arrays')
+            if meta['sources'] == sources and arrays is not None and ('item_train' in arrays or not pad_positives):
+                return cls.from_cache(cache_dir)
+        data = cls(DATA_ROOT, pad_positives=pad_positives)
+        data.save_cache(cache_dir)
+        return cls.from_cache(cache_dir)
+
     def get_length(self):
         '''
         map the user fields in all files, kept in self.user_fields dictionary
@@ -133,17 +255,30 @@ class LoadData(object):
                 self.max_positive_len=len(user_positive_list[i])
         return user_positive_list
 
-    def get_train_instances(self):
+    def get_train_instances(self, pad_positives=True):
+        '''
+        Build one training row per user. The positives of row r are also kept unpadded as
+        self.train_items[self.train_indptr[r]:self.train_indptr[r + 1]]
+        :param pad_positives: also build item_train padded with item_bind_M up to max_positive_len
+        :return: user_train, item_train (None if pad_positives is False)
+        '''
         user_train, item_train = [], []
+        train_lengths, train_items = [], []
         for i in self.user_positive_list:
             u_train = [int(feature) for feature in self.user_map[i].strip().split('-')[0:]]
             user_train.append(u_train)
             temp=self.user_positive_list[i]
+            train_lengths.append(len(temp))
+            train_items.extend(temp)
+            if not pad_positives:
+                continue
             while len(temp) < self.max_positive_len:
                 temp.append(self.item_bind_M)
             item_train.append(temp)
+        self.train_indptr = np.concatenate([[0], np.cumsum(train_lengths)]).astype(np.int64)
+        self.train_items = np.array(train_items, dtype=np.int32)
         user_train = np.array(user_train)
-        item_train = np.array(item_train)
+        item_train = np.array(item_train) if pad_positives else None
         return user_train, item_train
 
     def construct_data(self):
@@ -173,6 +308,31 @@ class LoadData(object):
         X_user, X_item = self.read_data(self.testfile)
         return X_user
 
+    def test_user_ids(self):
+        '''
+        Row in Train_data / Test_data of every user_test row, computed on the first call
+        :return: int64 array aligned with user_test
+        '''
+        if getattr(self, 'test_user_id', None) is None:
+            self.test_user_id = np.array([self.binded_users["-".join([str(item) for item in one])] for one in self.user_test],
+                                         dtype=np.int64)
+        return self.test_user_id
+
+    def unique_test_users(self):
+        '''
+        The distinct test users, in order of first appearance. user_test has a row per line of
+        test.csv, so a user with several test items repeats, while the user's Test_data row
+        already holds all of them: evaluation scores every user once
+        :return: (user_test rows of the distinct users, their rows in Train_data / Test_data)
+        '''
+        if getattr(self, 'test_users', None) is None:
+            test_user_id = self.test_user_ids()
+            first = np.sort(np.unique(test_user_id, return_index=True)[1])
+            self.test_users = (np.asarray(self.user_test)[first], test_user_id[first])
+            print("# of test users: %d distinct in %d test rows (evaluation work set %.1f%% smaller)"
+                  % (len(first), len(test_user_id), 100.0 * (1 - len(first) / max(len(test_user_id), 1))))
+        return self.test_users
+
 
 
     # lists of user and item
@@ -0,0 +1,112 @@
+import numpy as np
+
+# Top-K metrics of the evaluation scripts from one partial sort per batch: the items are
+# partitioned once at the largest cut-off, that prefix is sorted, and every metric at every
+# cut-off is read off the ranked hit matrix of the prefix. Per cut-off K, with hits the test
+# items among the top K and n the number of test items of the user:
+#   HR         hits / min(K, n) (what the scripts have always reported as HR)
+#   Recall     hits / n
+#   Precision  hits / K
+#   NDCG       DCG of the hits / DCG of min(K, n) hits at the top
+#   MRR        1 / rank of the first hit, 0 without a hit
+NAMES = ['HR', 'Recall', 'Precision', 'NDCG', 'MRR']
+
+
+def csr_rows(matrix, rows):
+    '''
+    Nonzero entries of some rows of a CSR matrix, read from its indptr/indices without slicing it
+    :param matrix: scipy CSR matrix, e.g. data.Train_data
+    :param rows: row ids
+    :return: (position in rows of every entry, column of every entry, entries per row)
+    '''
+    starts = matrix.indptr[rows]
+    lengths = matrix.indptr[np.asarray(rows) + 1] - starts
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+    return np.repeat(np.arange(len(lengths)), lengths), matrix.indices[positions], lengths
+
+def ranked_hits(data, pre, user_id, k):
+    '''
+    Rank the items of one batch of test users, with their training items masked out
+    :param data: LoadData instance
+    :param pre: [batch, items] scores without the padding item column (modified in place)
+    :param user_id: row of every batch user in data.Train_data / data.Test_data (see LoadData.test_user_ids)
+    :param k: length of the ranked prefix
+    :return: (hits [batch, k] bool, True where the item at that rank is a test item,
+              number of test items of every user)
+    '''
+    batch_users = len(user_id)
+    rows = np.arange(batch_users)[:, np.newaxis]
+    # the work of masking and of finding the hits is proportional to the users' interactions,
+    # not to the number of items
+    seen_rows, seen_items, _ = csr_rows(data.Train_data, user_id)
+    pre[seen_rows, seen_items] = -np.inf
+    k = min(k, pre.shape[1])
+    if k < pre.shape[1]:
+        # partition at n - k rather than negating the batch, which would copy it
+        top = np.argpartition(pre, pre.shape[1] - k, 1)[:, -k:]
+    else:
+        top = np.broadcast_to(np.arange(k), (batch_users, k))
+    top = top[rows, np.argsort(-pre[rows, top], axis=1, kind='stable')]
+    # a ranked item is a hit if (row, item) is one of the sorted test (row, item) keys
+    test_rows, test_items, n_true = csr_rows(data.Test_data, user_id)
+    truth = np.sort(test_rows * pre.shape[1] + test_items)
+    keys = rows * pre.shape[1] + top
+    if len(truth) == 0:
+        return np.zeros(keys.shape, dtype=bool), n_true
+    hits = truth[np.minimum(np.searchsorted(truth, keys), len(truth) - 1)] == keys
+    return hits, n_true
+
+def user_metrics(hits, n_true, topK):
+    '''
+    :param hits: ranked hit matrix of ranked_hits, with at least max(topK) columns
+    :param n_true: number of test items of every user
+    :return: {'<name>@<K>': per-user array} for every name in NAMES and K in topK
+    '''
+    discount = np.log(2) / np.log(np.arange(2, hits.shape[1] + 2))
+    dcg = np.cumsum(hits * discount, axis=1)
+    idcg = np.cumsum(discount)
+    cum_hits = np.cumsum(hits, axis=1)
+    # rank (from 1) of the first hit, or a rank past the prefix without one
+    first = np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, hits.shape[1] + 1)
+    metrics = {}
+    for kj in topK:
+        k = min(kj, hits.shape[1])
+        found = cum_hits[:, k - 1].astype(np.float64)
+        metrics['HR@%d' % kj] = found / np.minimum(kj, n_true)
+        metrics['Recall@%d' % kj] = found / n_true
+        metrics['Precision@%d' % kj] = found / kj
+        metrics['NDCG@%d' % kj] = dcg[:, k - 1] / idcg[np.minimum(k, n_true) - 1]
+        metrics['MRR@%d' % kj] = np.where(first <= k, 1.0 / first, 0.0)
+    return metrics
+
+
+class TopKMetrics(object):
+    '''
+    Streaming means of every metric in NAMES at every cut-off over the batches of an evaluation
+    '''
+
+    def __init__(self, topK):
+        '''
+        :param topK: cut-off or list of cut-offs
+        '''
+        self.topK = [int(k) for k in np.atleast_1d(topK)]
+        self.sums = dict.fromkeys(['%s@%d' % (name, k) for k in self.topK for name in NAMES], 0.0)
+        self.users = 0
+
+    def add(self, data, pre, user_id):
+        '''
+        Accumulate one batch, see ranked_hits for the arguments
+        '''
+        if len(user_id) == 0:
+            return
+        hits, n_true = ranked_hits(data, pre, user_id, max(self.topK))
+        for name, values in user_metrics(hits, n_true, self.topK).items():
+            self.sums[name] += values.sum()
+        self.users += len(user_id)
+
+    def result(self):
+        '''
+        :return: {'<name>@<K>': mean over the users added so far}
+        '''
+        return {name: total / max(self.users, 1) for name, total in self.sums.items()}
@@ -0,0 +1,129 @@
+import numpy as np
+
+# Approximate maximum inner product search (MIPS) for top-K retrieval without scoring every item.
+# The index is built offline from the item vectors of a ServingModel artifact with H_i_emb folded
+# in (q_emb * H_i_emb^T), so a user's score for an item is the plain inner product p_emb . item.
+#   IVF: k-means splits the items into n_lists lists; a query only visits the nprobe lists whose
+#        centroid has the largest inner product with it
+#   PQ:  the residual of every item to its centroid is product quantized to one uint8 code per
+#        subspace, so a candidate's approximate score is q.centroid plus n_subspaces table lookups
+#   re-rank: the rerank best candidates by approximate score are scored exactly and sorted
+
+def _nearest(x, centroids, chunk=8192):
+    # squared L2 distances without the constant |x|^2 term, a block of rows at a time
+    c_norm = np.square(centroids).sum(1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk):
+        block = x[start:start + chunk]
+        assign[start:start + chunk] = np.argmin(c_norm - 2.0 * block.dot(centroids.T), 1)
+    return assign
+
+def kmeans(x, k, iters=20, rng=None):
+    '''
+    Lloyd's k-means; an empty cluster is restarted at a random point
+    :return: (centroids [k, d], assignment of every row of x)
+    '''
+    rng = rng or np.random.RandomState(2019)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].astype(np.float32)
+    for _ in range(iters):
+        assign = _nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        for j in range(x.shape[1]):
+            centroids[:, j] = np.bincount(assign, weights=x[:, j], minlength=k) / np.maximum(counts, 1)
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    return centroids, _nearest(x, centroids)
+
+
+class MipsIndex(object):
+    '''
+    IVF-PQ index over item vectors with exact re-ranking
+    '''
+
+    def __init__(self, items, n_lists=None, n_subspaces=None, n_codes=256, iters=20, train_size=65536, seed=2019):
+        '''
+        :param items: [items, dim] item vectors (see from_model)
+        :param n_lists: number of IVF lists (default 4 * sqrt(items))
+        :param n_subspaces: number of PQ subspaces, dim is zero-padded to a multiple (default dim / 2)
+        :param n_codes: codes per subspace, at most 256
+        :param train_size: k-means of the PQ codebooks runs on a sample of this many residuals
+        '''
+        rng = np.random.RandomState(seed)
+        items = np.ascontiguousarray(items, dtype=np.float32)
+        n, dim = items.shape
+        n_lists = n_lists or max(1, int(4 * np.sqrt(n)))
+        self.n_subspaces = n_subspaces or (dim + 1) // 2
+        self.sub_dim = -(-dim // self.n_subspaces)
+        self.centroids, assign = kmeans(items, n_lists, iters, rng)
+        # items are stored list by list, so a list is one slice of ptr
+        order = np.argsort(assign, kind='stable')
+        self.ids = order
+        self.ptr = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(self.centroids)))])
+        self.vectors = items[order]
+        self.list_of = assign[order]
+        residuals = self._split(self.vectors - self.centroids[self.list_of])
+        sample = rng.choice(n, min(n, train_size), replace=False)
+        self.codebooks = np.zeros((self.n_subspaces, min(n_codes, 256), self.sub_dim), dtype=np.float32)
+        self.codes = np.empty((n, self.n_subspaces), dtype=np.uint8)
+        for m in range(self.n_subspaces):
+            codebook, _ = kmeans(residuals[sample, m], n_codes, iters, rng)
+            self.codebooks[m, :len(codebook)] = codebook
+            self.codes[:, m] = _nearest(residuals[:, m], self.codebooks[m])
+
+    @classmethod
+    def from_model(cls, model, **kwargs):
+        '''
+        :param model: ServingModel; its padding item (last q_emb row) is left out, so ids are q_emb rows
+        '''
+        return cls(model.q_emb[:-1] * model.H_i_emb.T, **kwargs)
+
+    def _split(self, x):
+        # [rows, dim] -> [rows, n_subspaces, sub_dim]
+        pad = self.n_subspaces * self.sub_dim - x.shape[1]
+        return np.pad(x, [[0, 0], [0, pad]]).reshape([len(x), self.n_subspaces, self.sub_dim])
+
+    def search(self, queries, k, nprobe=8, rerank=100, exclude=None):
+        '''
+        :param queries: [batch, dim] user vectors, ServingModel.user_tower output
+        :param k: number of items to return
+        :param nprobe: number of lists a query visits
+        :param rerank: number of candidates scored exactly (at least k)
+        :param exclude: optional CSR matrix with one row per query of item ids not to return (training items)
+        :return: [batch, k] item ids by decreasing exact score, -1 where fewer than k candidates were found
+        '''
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = min(nprobe, len(self.centroids))
+        rerank = max(rerank, k)
+        coarse = queries.dot(self.centroids.T)
+        probe = np.argpartition(-coarse, nprobe - 1, 1)[:, :nprobe]
+        # lookup tables: inner product of every query subvector with every code of its subspace
+        lut = np.einsum('bmd,mcd->bmc', self._split(queries), self.codebooks)
+        subspaces = np.arange(self.n_subspaces)
+        result = np.full((len(queries), k), -1, dtype=np.int64)
+        for b in range(len(queries)):
+            rows = np.concatenate([np.arange(self.ptr[l], self.ptr[l + 1]) for l in probe[b]])
+            approx = coarse[b, self.list_of[rows]] + lut[b, subspaces, self.codes[rows]].sum(1)
+            if exclude is not None:
+                seen = exclude.indices[exclude.indptr[b]:exclude.indptr[b + 1]]
+                keep = ~np.isin(self.ids[rows], seen)
+                rows, approx = rows[keep], approx[keep]
+            if len(rows) > rerank:
+                rows = rows[np.argpartition(-approx, rerank - 1)[:rerank]]
+            exact = self.vectors[rows].dot(queries[b])
+            top = rows[np.argsort(-exact, kind='stable')[:k]]
+            result[b, :len(top)] = self.ids[top]
+        return result
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, ids=self.ids, ptr=self.ptr, vectors=self.vectors,
+                 list_of=self.list_of, codebooks=self.codebooks, codes=self.codes)
+
+    @classmethod
+    def load(cls, path):
+        index = cls.__new__(cls)
+        with np.load(path) as f:
+            for name in f.files:
+                setattr(index, name, f[name])
+        index.n_subspaces, _, index.sub_dim = index.codebooks.shape
+        return index
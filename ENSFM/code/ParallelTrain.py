@@ -0,0 +1,148 @@
+import multiprocessing
+import os
+import queue as queue_module
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+# Synchronous data-parallel training of ENSFM_tf2.ENSFMModule on local CPU processes.
+#
+# Every worker owns a fixed shard of the LoadData training rows and holds a full replica
+# of the parameters. A step splits the global batch into one local batch per worker; each
+# worker computes the gradient of its local loss, the gradients are summed through shared
+# memory, and every replica applies the same Adagrad update, so the replicas never drift apart.
+#
+# The loss is a sum over users: the whole-data term is w * sum(Q_gram * P_gram * H H^T),
+# with Q_gram over all items and P_gram = sum of p p^T over the batch users. Each shard
+# therefore computes the full item Gram matrix and only its own users' P_gram. Summing
+# (not averaging) the shard gradients of the data term gives exactly its gradient on the full
+# batch; the regularizer does not depend on the batch, so every replica adds its gradient once.
+#
+# The item side reaches every item each step, so the gradients of ENSFMModule.dense_params are
+# summed with a reduce-scatter/all-gather. The user tables only get gradients in the rows of the
+# batch users: workers exchange those rows and their gradients (an all-gather of
+# batch_size * user fields rows) instead of the whole uidW and u_bias tables.
+
+
+def flatten(values):
+    return np.concatenate([np.asarray(value, dtype=np.float32).ravel() for value in values])
+
+
+def unflatten(flat, shapes):
+    values, offset = [], 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        values.append(flat[offset:offset + size].reshape(shape))
+        offset += size
+    return values
+
+
+def _worker(rank, n_workers, model_inputs, user_train, item_train, args, seed, init_params, steps,
+            dense_size, buffer_names, barrier, queue):
+    # split the cores between the workers before TensorFlow starts its thread pools
+    import tensorflow as tf
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    import ENSFM_tf2
+
+    # identical seeds give every replica the same dropout masks
+    tf.random.set_seed(seed)
+    module = ENSFM_tf2.ENSFMModule(*model_inputs, args)
+    shapes = [v.shape.as_list() for v in module.params]
+    for v, value in zip(module.params, unflatten(init_params, shapes)):
+        v.assign(value)
+    dense_shapes = [v.shape.as_list() for v in module.dense_params]
+    local_batch = args.batch_size // n_workers
+    local_rows = local_batch * user_train.shape[1]
+    # dense gradients and loss_no_reg, summed; then the user row gradients, gathered
+    reduced_size = dense_size + 1
+    size = reduced_size + local_rows * (args.embed_size + 1)
+    shms = [shared_memory.SharedMemory(name=name) for name in buffer_names]
+    grads_buf = np.ndarray((n_workers, size), dtype=np.float32, buffer=shms[0].buf)
+    reduced_buf = np.ndarray((reduced_size,), dtype=np.float32, buffer=shms[1].buf)
+    rows_buf = np.ndarray((n_workers, local_rows), dtype=np.int32, buffer=shms[2].buf)
+    lo, hi = reduced_size * rank // n_workers, reduced_size * (rank + 1) // n_workers
+    rng = np.random.RandomState(seed + rank)
+
+    for epoch in range(args.epochs):
+        start_t = time.time()
+        loss = np.zeros(3)
+        order = rng.permutation(len(user_train))
+        for step in range(steps):
+            idx = order[step * local_batch:(step + 1) * local_batch]
+            grads, user_grads, _, loss1, loss2 = module.sparse_gradients(user_train[idx], item_train[idx], args.dropout)
+            grads_buf[rank, :dense_size] = flatten([grad.numpy() for grad in grads])
+            grads_buf[rank, dense_size] = loss1
+            grads_buf[rank, reduced_size:] = user_grads.numpy().ravel()
+            rows_buf[rank] = user_train[idx].ravel()
+            barrier.wait()
+            reduced_buf[lo:hi] = grads_buf[:, lo:hi].sum(0)
+            # copied before the barrier: past it, faster workers write their next step
+            rows = rows_buf.ravel().copy()
+            row_grads = grads_buf[:, reduced_size:].copy().reshape(-1, args.embed_size + 1)
+            barrier.wait()
+            module.apply_sparse_gradients(unflatten(reduced_buf[:dense_size], dense_shapes), rows, row_grads)
+            loss += [reduced_buf[dense_size] + float(loss2), reduced_buf[dense_size], float(loss2)]
+        if rank == 0:
+            params = None
+            if epoch % args.verbose == 0 or epoch == args.epochs - 1:
+                params = flatten([v.numpy() for v in module.params])
+            queue.put((epoch, loss / max(steps, 1), steps, time.time() - start_t, params))
+    for shm in shms:
+        shm.close()
+
+
+def train(data, args, init_params, seed=2019):
+    '''
+    Train on args.workers local processes
+    :param data: LoadData instance with padded positives
+    :param args: parsed ENSFM arguments (workers, batch_size, epochs, verbose, dropout, lr, ...)
+    :param init_params: flattened initial values of ENSFMModule.params
+    :param seed: seed for dropout and the per-shard shuffles
+    :return: generator of (epoch, mean losses, steps, epoch seconds, flattened params or None);
+             params are sent on evaluation epochs (epoch % verbose == 0) and after the last epoch
+    '''
+    n_workers = args.workers
+    ctx = multiprocessing.get_context('spawn')
+    shards = [np.arange(rank, len(data.user_train), n_workers) for rank in range(n_workers)]
+    local_batch = args.batch_size // n_workers
+    steps = min(len(shard) for shard in shards) // local_batch
+    model_inputs = (data.item_map_list, data.user_field_M, data.item_field_M, args.embed_size, data.max_positive_len)
+    # every parameter but uidW and u_bias, [user_field_M, embed_size] and [user_field_M, 1]
+    dense_size = len(init_params) - data.user_field_M * (args.embed_size + 1)
+    local_rows = local_batch * data.user_train.shape[1]
+    shms = [shared_memory.SharedMemory(create=True, size=4 * n_workers * (dense_size + 1 + local_rows * (args.embed_size + 1))),
+            shared_memory.SharedMemory(create=True, size=4 * (dense_size + 1)),
+            shared_memory.SharedMemory(create=True, size=4 * n_workers * local_rows)]
+    barrier = ctx.Barrier(n_workers)
+    queue = ctx.Queue()
+    workers = []
+    for rank, shard in enumerate(shards):
+        worker = ctx.Process(target=_worker, args=(
+            rank, n_workers, model_inputs, data.user_train[shard].astype(np.int32),
+            data.item_train[shard].astype(np.int32), args, seed, init_params, steps,
+            dense_size, [shm.name for shm in shms], barrier, queue))
+        worker.start()
+        workers.append(worker)
+    try:
+        for _ in range(args.epochs):
+            while True:
+                try:
+                    message = queue.get(timeout=10)
+                    break
+                except queue_module.Empty:
+                    if any(worker.exitcode not in (None, 0) for worker in workers):
+                        raise RuntimeError('a training worker exited with an error')
+            yield message
+    except BaseException:
+        # a worker left waiting on the barrier would otherwise block the join below
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+        for shm in shms:
+            shm.close()
+            shm.unlink()
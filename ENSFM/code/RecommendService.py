@@ -0,0 +1,210 @@
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+import queue
+import threading
+import time
+import urllib.parse
+import numpy as np
+import LoadData as DATA
+import ServingModel
+
+# Local HTTP top-K recommendation service over a ServingModel artifact.
+#   GET /recommend?user=a-b-c&k=10  user features in the train.csv format -> {"items": [...], "scores": [...]}
+#   GET /stats                      latency percentiles and throughput of the last --window requests
+# Every request thread hands its user to one MicroBatcher thread, which coalesces the users that
+# arrive within --max_wait_ms (at most --max_batch) and scores them with one matrix product
+# against the preloaded item matrix, like evaluate() scores eva_batch users at a time.
+
+
+class MicroBatcher(object):
+    '''
+    Dynamic micro-batching of single-user top-K requests
+    '''
+
+    def __init__(self, model, data=None, max_batch=128, max_wait_ms=5.0, window=10000):
+        '''
+        :param model: ServingModel
+        :param data: LoadData whose training items are excluded for the users it knows, or None
+        :param max_batch: largest batch scored at once
+        :param max_wait_ms: longest time the first user of a batch waits for more users
+        :param window: number of recent requests the latency and throughput counters cover
+        '''
+        self.model = model
+        self.data = data
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        # the item matrix is read for every batch: keep it in memory, H_i_emb folded in, without the padding item
+        self.items_T = np.ascontiguousarray((model.q_emb[:-1] * model.H_i_emb.T).T)
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.done_times = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.counts = {'requests': 0, 'batches': 0}
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, input_u, user_key=None, k=10):
+        '''
+        :param input_u: user feature ids
+        :param user_key: "a-b-c" string of the user, looked up in data.binded_users for the items to exclude
+        :return: Future of (item ids, scores) of the k best items
+        '''
+        future = concurrent.futures.Future()
+        self.requests.put((time.time(), input_u, user_key, k, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        if batch[0] is None:
+            return None
+        deadline = batch[0][0] + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                request = self.requests.get(timeout=max(deadline - time.time(), 0.0))
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._score(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request[-1].done():
+                        request[-1].set_exception(e)
+
+    def _score(self, batch):
+        pre = self.model.user_tower(np.array([request[1] for request in batch], dtype=np.int64)).dot(self.items_T)
+        if self.data is not None:
+            for row, request in enumerate(batch):
+                user_id = self.data.binded_users.get(request[2])
+                if user_id is not None:
+                    start, end = self.data.Train_data.indptr[user_id:user_id + 2]
+                    pre[row, self.data.Train_data.indices[start:end]] = -np.inf
+        k = min(max(request[3] for request in batch), pre.shape[1] - 1)
+        top = np.argpartition(-pre, k, 1)[:, :k]
+        top_scores = np.take_along_axis(pre, top, 1)
+        order = np.argsort(-top_scores, 1)
+        top, top_scores = np.take_along_axis(top, order, 1), np.take_along_axis(top_scores, order, 1)
+        now = time.time()
+        with self.lock:
+            self.counts['requests'] += len(batch)
+            self.counts['batches'] += 1
+            self.batch_sizes.append(len(batch))
+            for request in batch:
+                self.latencies.append(now - request[0])
+                self.done_times.append(now)
+        for row, request in enumerate(batch):
+            n = request[3]
+            seen = np.isinf(top_scores[row, :n])
+            request[-1].set_result((top[row, :n][~seen].tolist(), top_scores[row, :n][~seen].tolist()))
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            done_times = list(self.done_times)
+            stats = dict(self.counts, mean_batch=float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0)
+        if len(latencies):
+            stats['p50_ms'], stats['p99_ms'] = [float(v) for v in np.percentile(latencies, [50, 99])]
+        span = done_times[-1] - done_times[0] if len(done_times) > 1 else 0.0
+        stats['requests_per_sec'] = (len(done_times) - 1) / span if span > 0 else 0.0
+        stats['uptime_sec'] = time.time() - self.start_time
+        return stats
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+def make_server(batcher, host='127.0.0.1', port=8080, max_k=1000):
+    '''
+    :return: ThreadingHTTPServer answering /recommend and /stats with batcher, not started yet
+    '''
+    n_fields = batcher.data.user_test.shape[1] if batcher.data is not None else None
+    user_field_M = len(batcher.model.uidW)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body go out in separate writes: with Nagle on, every keep-alive reply
+        # waits ~40 ms for the client's delayed ACK of the headers
+        disable_nagle_algorithm = True
+
+        def _reply(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            if url.path == '/stats':
+                return self._reply(200, batcher.stats())
+            if url.path != '/recommend':
+                return self._reply(404, {'error': 'unknown path %s' % url.path})
+            user = query.get('user', [''])[0]
+            try:
+                input_u = [int(feature) for feature in user.split('-')]
+                k = int(query.get('k', ['10'])[0])
+            except ValueError:
+                return self._reply(400, {'error': 'user must be feature ids joined by "-" and k an integer'})
+            if n_fields is not None and len(input_u) != n_fields:
+                return self._reply(400, {'error': 'expected %d user features, got %d' % (n_fields, len(input_u))})
+            if not all(0 <= feature < user_field_M for feature in input_u) or not 0 < k <= max_k:
+                return self._reply(400, {'error': 'user features must be in [0, %d) and k in (0, %d]' % (user_field_M, max_k)})
+            items, scores = batcher.submit(input_u, user, k).result()
+            self._reply(200, {'user': user, 'items': items, 'scores': scores})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve ENSFM top-K recommendations over HTTP with dynamic micro-batching")
+    parser.add_argument('--export', nargs='?', required=True,
+                        help='ServingModel artifact directory (ENSFM.py --export)')
+    parser.add_argument('--dataset', nargs='?', default=None,
+                        help='Dataset whose training items are excluded from the recommendations (default: none)')
+    parser.add_argument('--host', nargs='?', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on')
+    parser.add_argument('--max_batch', type=int, default=128,
+                        help='Largest micro-batch')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                        help='Latency budget a request may wait for its micro-batch to fill')
+    parser.add_argument('--window', type=int, default=10000,
+                        help='Number of recent requests the /stats counters cover')
+    return parser.parse_args()
+
+def load_batcher(args):
+    model = ServingModel.ServingModel(args.export)
+    data = DATA.LoadData.cached(DATA.get_data_root(args.dataset), pad_positives=False) if args.dataset else None
+    return MicroBatcher(model, data, args.max_batch, args.max_wait_ms, args.window)
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = make_server(load_batcher(args), args.host, args.port)
+    print("serving on http://%s:%d/recommend?user=<a-b-c>&k=10, counters on /stats" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
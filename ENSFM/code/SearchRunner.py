@@ -0,0 +1,119 @@
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+import LoadData as DATA
+import ENSFM_light
+
+# Hyperparameter search over a process pool. The dataset is parsed once into a LoadData
+# cache (see LoadData.cached); every worker memory-maps the same cache instead of parsing
+# the csv files again, runs ENSFM_light.run_experiment for one config at a time with its own
+# thread budget, and the parent appends each result to one JSONL store as soon as it lands.
+
+def search_parser(description):
+    # no abbreviations, or ENSFM_light's --lr/--dropout would be taken for --lr_values/--dropout_values
+    parser = argparse.ArgumentParser(description=description, allow_abbrev=False,
+                                     epilog="Other arguments are passed on to ENSFM_light.parse_args")
+    parser.add_argument('--processes', type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help='Configs trained at the same time')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='TensorFlow threads per worker (0: cores / processes)')
+    parser.add_argument('--lr_values', nargs='?', default='0.005,0.01,0.02,0.05',
+                        help='Comma separated learning rates')
+    parser.add_argument('--dropout_values', nargs='?', default='0.1,0.3,0.5,0.7,0.9,1.0',
+                        help='Comma separated dropout keep_probs')
+    parser.add_argument('--neg_weight_values', nargs='?', default='0.001,0.005,0.01,0.05,0.1,0.5,1.0',
+                        help='Comma separated negative weights')
+    parser.add_argument('--results', nargs='?', default=None,
+                        help='JSONL results store (default: <dataset dir>/ENSFM_search_results.jsonl)')
+    return parser
+
+def parse_args():
+    search_args, model_argv = search_parser("Parallel ENSFM hyperparameter search").parse_known_args()
+    return search_args, model_argv
+
+def grid(search_args):
+    values = [[float(v) for v in getattr(search_args, name).split(',')]
+              for name in ['lr_values', 'dropout_values', 'neg_weight_values']]
+    return [{'lr': lr, 'dropout': dropout, 'negative_weight': neg_weight}
+            for lr, dropout, neg_weight in itertools.product(*values)]
+
+def _init_worker(cache_dir, model_argv, threads, log_dir):
+    # one log file per worker keeps the per-epoch prints of parallel runs apart
+    log = open(os.path.join(log_dir, 'worker-%d.log' % os.getpid()), 'a', buffering=1)
+    sys.stdout = log
+    sys.stderr = log
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    # evaluate() and train_step1() read these module globals
+    ENSFM_light.args = ENSFM_light.parse_args(model_argv)
+    ENSFM_light.data = DATA.LoadData.from_cache(cache_dir)
+
+def _run_config(config, random_seed=2019, checkpoint_dir=None):
+    import numpy as np
+    np.random.seed(random_seed)
+    args = ENSFM_light.args
+    for name, value in config.items():
+        setattr(args, name, value)
+    print("Running experiment with", config)
+    start_t = time.time()
+    hr, ndcg = ENSFM_light.run_experiment(args, ENSFM_light.data, random_seed, checkpoint_dir)
+    return {'config': config, 'HR@10': float(hr), 'NDCG@10': float(ndcg),
+            'seconds': time.time() - start_t, 'pid': os.getpid()}
+
+def make_pool(DATA_ROOT, model_argv, processes, threads=0, log_dir='search_logs'):
+    '''
+    Start a process pool whose workers share one memory-mapped LoadData cache of DATA_ROOT
+    :param model_argv: base ENSFM_light command line arguments
+    :param threads: TensorFlow threads per worker (0: cores / processes)
+    :param log_dir: directory of the per-worker log files
+    :return: concurrent.futures.ProcessPoolExecutor
+    '''
+    model_args = ENSFM_light.parse_args(model_argv)
+    DATA.LoadData.cached(DATA_ROOT, pad_positives=model_args.positives == 'padded')
+    cache_dir = os.path.join(DATA_ROOT, 'cache')
+    threads = threads or max(1, (os.cpu_count() or 1) // processes)
+    os.makedirs(log_dir, exist_ok=True)
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker, initargs=(cache_dir, model_argv, threads, log_dir))
+
+def run_search(configs, DATA_ROOT, model_argv, processes, threads=0, results_path=None, run_fn=_run_config):
+    '''
+    Train every config on a process pool that shares one memory-mapped LoadData cache
+    :param configs: list of dicts of ENSFM_light argument overrides
+    :param model_argv: base ENSFM_light command line arguments
+    :param run_fn: picklable function(config) run in the workers, returning a result dict
+    :return: list of result dicts in completion order
+    '''
+    results_path = results_path or os.path.join(DATA_ROOT, 'ENSFM_search_results.jsonl')
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(results_path)), 'search_logs')
+    results = []
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+    with open(results_path, 'a') as store, make_pool(DATA_ROOT, model_argv, processes, threads, log_dir) as pool:
+        futures = [pool.submit(run_fn, config) for config in configs]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            store.write(json.dumps(result) + '\n')
+            store.flush()
+            results.append(result)
+            print("[%d/%d] %s => HR@10: %.4f, NDCG@10: %.4f (%.1fs)"
+                  % (len(results), len(configs), result['config'], result['HR@10'], result['NDCG@10'], result['seconds']))
+    return results
+
+if __name__ == '__main__':
+    search_args, model_argv = parse_args()
+    model_args = ENSFM_light.parse_args(model_argv)
+    DATA_ROOT = DATA.get_data_root(model_args.dataset)
+    configs = grid(search_args)
+    start_t = time.time()
+    results = run_search(configs, DATA_ROOT, model_argv, search_args.processes, search_args.threads, search_args.results)
+    print("Search of %d configs took %.1fs" % (len(configs), time.time() - start_t))
+    print("\nSorted hyperparameter search results (by HR@10 in descending order):")
+    for result in sorted(results, key=lambda r: r['HR@10'], reverse=True):
+        print("Parameters: {}  => HR@10: {}, NDCG@10: {}".format(result['config'], result['HR@10'], result['NDCG@10']))
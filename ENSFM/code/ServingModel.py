@@ -0,0 +1,109 @@
+import json
+import os
+import numpy as np
+
+# TensorFlow-free serving artifact of a trained ENSFM model. export() writes one .npy file per
+# array plus manifest.json into a directory; ServingModel memory-maps the arrays back, so
+# loading costs a few file opens whatever the catalogue size, and scores users with NumPy only.
+#   q_emb    [items, d+2]  item tower, last row is the padding item (LoadData.item_bind_M)
+#   H_i_emb  [d+2, 1]      prediction weights [H_i; 1; 1]
+#   uidW     [user_field_M, d], u_bias [user_field_M, 1], H_s [d, 1], bias []  user tower parameters
+# The item side is float32; the user side keeps float64 if the model has it (ENSFM_eals), whose
+# user tower is computed in float64 and only rounded to float32 before scoring.
+
+FORMAT = 'ensfm-serving'
+FORMAT_VERSION = 1
+ARRAYS = ['q_emb', 'H_i_emb', 'uidW', 'u_bias', 'H_s', 'bias']
+
+def export(directory, q_emb, H_i_emb, uidW, u_bias, H_s, bias, **meta):
+    '''
+    Write a serving artifact; extra keyword arguments (dataset, epoch, ...) go to the manifest
+    :return: path of the manifest
+    '''
+    os.makedirs(directory, exist_ok=True)
+    d = np.shape(uidW)[1]
+    user_dtype = np.result_type(uidW, np.float32)
+    arrays = {
+        'q_emb': np.asarray(q_emb, dtype=np.float32),
+        'H_i_emb': np.reshape(H_i_emb, [d + 2, 1]).astype(np.float32),
+        'uidW': np.asarray(uidW, dtype=user_dtype),
+        'u_bias': np.reshape(u_bias, [-1, 1]).astype(user_dtype),
+        'H_s': np.reshape(H_s, [d, 1]).astype(user_dtype),
+        'bias': np.asarray(bias, dtype=user_dtype).reshape([]),
+    }
+    for name in ARRAYS:
+        np.save(os.path.join(directory, name + '.npy'), arrays[name])
+    manifest = dict(meta, format=FORMAT, version=FORMAT_VERSION, embed_size=d,
+                    n_items=len(arrays['q_emb']), user_field_M=len(arrays['uidW']),
+                    shapes={name: list(arrays[name].shape) for name in ARRAYS})
+    # the manifest goes last, so a directory with a manifest always holds a complete artifact
+    path = os.path.join(directory, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+class ServingModel(object):
+    '''
+    NumPy scorer over an export() directory; score() reproduces ENSFM.pre (gemm score mode)
+    '''
+
+    def __init__(self, directory, mmap_mode='r'):
+        '''
+        :param mmap_mode: np.load mmap_mode, None reads the arrays into memory
+        '''
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != FORMAT or self.manifest.get('version') != FORMAT_VERSION:
+            raise ValueError('%s is not an %s artifact of version %d (found %s version %s)'
+                             % (directory, FORMAT, FORMAT_VERSION, self.manifest.get('format'), self.manifest.get('version')))
+        for name in ARRAYS:
+            value = np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+            if list(value.shape) != self.manifest['shapes'][name]:
+                raise ValueError('%s.npy has shape %s, the manifest says %s' % (name, value.shape, self.manifest['shapes'][name]))
+            setattr(self, name, value)
+        self.bias = self.bias[()]
+        self.embed_size = self.manifest['embed_size']
+        self.n_items = self.manifest['n_items']
+
+    def user_tower(self, input_u):
+        '''
+        :param input_u: [batch, user fields] user feature ids
+        :return: p_emb [batch, d+2] float32
+        '''
+        user_feature_emb = self.uidW[np.asarray(input_u)]
+        summed_user_emb = user_feature_emb.sum(1)
+        user_cross = 0.5 * (np.square(summed_user_emb) - np.square(user_feature_emb).sum(1))
+        user_bias = self.u_bias[np.asarray(input_u)].sum(1)
+        I = np.ones((len(summed_user_emb), 1), dtype=summed_user_emb.dtype)
+        p_emb = np.hstack([summed_user_emb, user_cross.dot(self.H_s) + user_bias + self.bias, I])
+        return p_emb.astype(np.float32, copy=False)
+
+    def score(self, input_u):
+        '''
+        :return: [batch, items] scores, the last column being the padding item like ENSFM.pre
+        '''
+        p_weighted = self.user_tower(input_u) * self.H_i_emb.T
+        return p_weighted.dot(self.q_emb.T)
+
+def export_checkpoint(directory, checkpoint, item_attribute, **meta):
+    '''
+    Export a Checkpoint.Checkpointer file of the graph model without TensorFlow: the item
+    tower is computed with NumPy from the checkpointed variables
+    :param checkpoint: ckpt-<epoch>.npz path
+    :param item_attribute: LoadData.item_map_list
+    :return: path of the manifest
+    '''
+    with np.load(checkpoint) as f:
+        var = {name: f['var/' + name] for name in ['uidW', 'iidW', 'hi', 'hs', 'u_bias', 'i_bias', 'bias']}
+        epoch = int(f['epoch'])
+    item_attribute = np.asarray(item_attribute)
+    all_item_feature_emb = var['iidW'][item_attribute]
+    summed_all_item_emb = all_item_feature_emb.sum(1)
+    item_cross = 0.5 * (np.square(summed_all_item_emb) - np.square(all_item_feature_emb).sum(1))
+    item_bias = var['i_bias'][item_attribute].sum(1)
+    I = np.ones((len(item_attribute), 1), dtype=np.float32)
+    q_emb = np.hstack([summed_all_item_emb, I, item_cross.dot(var['hs']) + item_bias])
+    H_i_emb = np.vstack([var['hi'], [[1.0], [1.0]]])
+    return export(directory, q_emb, H_i_emb, var['uidW'], var['u_bias'], var['hs'], var['bias'], epoch=epoch, **meta)
@@ -0,0 +1,187 @@
+import concurrent.futures
+import json
+import os
+import shutil
+import time
+import numpy as np
+import LoadData as DATA
+import ENSFM_light
+import SearchRunner
+
+# Asynchronous successive halving (ASHA, Li et al. 2018) on the SearchRunner process pool.
+# Every sampled config starts with the smallest epoch budget (rung 0); the budgets grow by a
+# factor eta per rung up to --epochs. Whenever a worker is free it continues the best config
+# that is in the top 1/eta of its rung and not promoted yet (highest rung first) from its
+# checkpoint up to the next budget, and only starts a new config if there is none, so most
+# configs are dropped after a few epochs and only the best ones are trained to the end.
+
+# (config key, range argument, sampled on a log scale)
+SPACE = [('lr', 'lr_range', True), ('dropout', 'dropout_range', False), ('negative_weight', 'neg_weight_range', True)]
+
+def parse_args():
+    parser = SearchRunner.search_parser("Successive halving (ASHA) ENSFM hyperparameter search")
+    parser.add_argument('--sampler', nargs='?', default='lhs', choices=['grid', 'random', 'lhs'],
+                        help='grid: shuffled --*_values grid; random: uniform; lhs: Latin hypercube over the --*_range box')
+    parser.add_argument('--configs', type=int, default=81,
+                        help='Number of configs to sample (at most the grid size for the grid sampler)')
+    parser.add_argument('--lr_range', nargs='?', default='0.005,0.05',
+                        help='Learning rate range (log scale)')
+    parser.add_argument('--dropout_range', nargs='?', default='0.1,1.0',
+                        help='Dropout keep_prob range')
+    parser.add_argument('--neg_weight_range', nargs='?', default='0.001,1.0',
+                        help='Negative weight range (log scale)')
+    parser.add_argument('--min_epochs', type=int, default=2,
+                        help='Epoch budget of the first rung; the last rung trains for --epochs')
+    parser.add_argument('--eta', type=int, default=3,
+                        help='Budget growth factor between rungs; the top 1/eta of a rung is promoted')
+    parser.add_argument('--metric', nargs='?', default='NDCG@10', choices=['HR@10', 'NDCG@10'],
+                        help='Metric the configs are ranked by (the other one breaks ties)')
+    parser.add_argument('--seed', type=int, default=2019,
+                        help='Seed of the config sampler')
+    search_args, model_argv = parser.parse_known_args()
+    return search_args, model_argv
+
+def sample_configs(search_args, rng):
+    n = search_args.configs
+    if search_args.sampler == 'grid':
+        configs = SearchRunner.grid(search_args)
+        return [configs[i] for i in rng.permutation(len(configs))[:n]]
+    if search_args.sampler == 'random':
+        u = rng.uniform(size=(n, len(SPACE)))
+    else:
+        # one sample in each of the n strata of every dimension, strata paired at random
+        u = (np.stack([rng.permutation(n) for _ in SPACE], 1) + rng.uniform(size=(n, len(SPACE)))) / n
+    configs = [{} for _ in range(n)]
+    for j, (name, range_arg, log_scale) in enumerate(SPACE):
+        lo, hi = [float(v) for v in getattr(search_args, range_arg).split(',')]
+        if log_scale:
+            values = np.exp(np.log(lo) + u[:, j] * (np.log(hi) - np.log(lo)))
+        else:
+            values = lo + u[:, j] * (hi - lo)
+        for config, value in zip(configs, values):
+            config[name] = float(value)
+    return configs
+
+def rung_budgets(min_epochs, max_epochs, eta):
+    budgets = [min(min_epochs, max_epochs)]
+    while budgets[-1] * eta < max_epochs:
+        budgets.append(budgets[-1] * eta)
+    if budgets[-1] < max_epochs:
+        budgets.append(max_epochs)
+    return budgets
+
+
+class ASHA(object):
+    '''
+    Promotion bookkeeping of asynchronous successive halving: rung k holds the metrics of
+    every config trained for budgets[k] epochs, and a config becomes promotable to rung k+1
+    as soon as it is in the top len(rung k) // eta of rung k.
+    '''
+
+    def __init__(self, n_rungs, eta, metric):
+        self.eta = eta
+        self.key = lambda metrics: (metrics[metric], metrics['NDCG@10' if metric == 'HR@10' else 'HR@10'])
+        self.rungs = [{} for _ in range(n_rungs)]
+        self.promoted = [set() for _ in range(n_rungs)]
+
+    def report(self, trial, rung, metrics):
+        self.rungs[rung][trial] = metrics
+
+    def next_promotion(self):
+        '''
+        :return: (trial, rung to train it to), or None if no config can be promoted yet
+        '''
+        for rung in reversed(range(len(self.rungs) - 1)):
+            results = self.rungs[rung]
+            top = sorted(results, key=lambda trial: self.key(results[trial]), reverse=True)[:len(results) // self.eta]
+            for trial in top:
+                if trial not in self.promoted[rung]:
+                    self.promoted[rung].add(trial)
+                    return trial, rung + 1
+        return None
+
+    def best(self):
+        '''
+        :return: (trial, rung) of the best config of the highest rung reached
+        '''
+        rung = max(k for k, results in enumerate(self.rungs) if results)
+        results = self.rungs[rung]
+        return max(results, key=lambda trial: self.key(results[trial])), rung
+
+
+def run_asha(configs, DATA_ROOT, model_argv, processes, budgets, eta=3, metric='NDCG@10', threads=0, results_path=None):
+    '''
+    Run ASHA over the configs on a SearchRunner process pool
+    :param configs: list of dicts of ENSFM_light argument overrides, started in this order
+    :param budgets: epoch budget of every rung, see rung_budgets
+    :return: (ASHA instance, epochs trained in total)
+    '''
+    results_path = results_path or os.path.join(DATA_ROOT, 'ENSFM_asha_results.jsonl')
+    search_dir = os.path.dirname(os.path.abspath(results_path))
+    os.makedirs(search_dir, exist_ok=True)
+    checkpoint_root = os.path.join(search_dir, 'search_checkpoints')
+    # a trial continues from whatever checkpoint its directory holds, so none may be left from an earlier search
+    shutil.rmtree(checkpoint_root, ignore_errors=True)
+    scheduler = ASHA(len(budgets), eta, metric)
+    pending = list(range(len(configs)))
+    running = {}
+    epochs_trained = 0
+    with open(results_path, 'a') as store, SearchRunner.make_pool(
+            DATA_ROOT, model_argv, processes, threads, os.path.join(search_dir, 'search_logs')) as pool:
+
+        def submit():
+            job = scheduler.next_promotion()
+            if job is None:
+                if not pending:
+                    return False
+                job = pending.pop(0), 0
+            trial, rung = job
+            config = dict(configs[trial], epochs=budgets[rung], verbose=0)
+            checkpoint_dir = os.path.join(checkpoint_root, 'trial-%d' % trial)
+            running[pool.submit(SearchRunner._run_config, config, checkpoint_dir=checkpoint_dir)] = job
+            return True
+
+        while len(running) < processes and submit():
+            pass
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                trial, rung = running.pop(future)
+                result = future.result()
+                result.update({'trial': trial, 'rung': rung})
+                scheduler.report(trial, rung, result)
+                epochs_trained += budgets[rung] - (budgets[rung - 1] if rung > 0 else 0)
+                store.write(json.dumps(result) + '\n')
+                store.flush()
+                print("trial %d rung %d (%d epochs) %s => HR@10: %.4f, NDCG@10: %.4f (%.1fs)"
+                      % (trial, rung, budgets[rung], configs[trial], result['HR@10'], result['NDCG@10'], result['seconds']))
+            while len(running) < processes and submit():
+                pass
+    # only the checkpoint of the winning config is worth keeping
+    best_trial, _ = scheduler.best()
+    for trial in range(len(configs)):
+        if trial != best_trial:
+            shutil.rmtree(os.path.join(checkpoint_root, 'trial-%d' % trial), ignore_errors=True)
+    return scheduler, epochs_trained
+
+if __name__ == '__main__':
+    search_args, model_argv = parse_args()
+    model_args = ENSFM_light.parse_args(model_argv)
+    if model_args.engine == 'tf2' or model_args.optimizer == 'eals':
+        raise ValueError('successive halving continues configs from checkpoints and needs --engine graph and --optimizer adagrad')
+    DATA_ROOT = DATA.get_data_root(model_args.dataset)
+    configs = sample_configs(search_args, np.random.RandomState(search_args.seed))
+    budgets = rung_budgets(search_args.min_epochs, model_args.epochs, search_args.eta)
+    print("%d configs, rung budgets (epochs): %s" % (len(configs), budgets))
+    start_t = time.time()
+    scheduler, epochs_trained = run_asha(configs, DATA_ROOT, model_argv, search_args.processes, budgets,
+                                         search_args.eta, search_args.metric, search_args.threads, search_args.results)
+    print("Search of %d configs took %.1fs, %d training epochs instead of %d for the full budget on every config (%.1fx less)"
+          % (len(configs), time.time() - start_t, epochs_trained, len(configs) * budgets[-1],
+             len(configs) * budgets[-1] / max(epochs_trained, 1)))
+    for rung, results in enumerate(scheduler.rungs):
+        print("\nRung %d (%d epochs), sorted by %s:" % (rung, budgets[rung], search_args.metric))
+        for trial in sorted(results, key=lambda trial: scheduler.key(results[trial]), reverse=True):
+            print("Trial {}: {}  => HR@10: {}, NDCG@10: {}".format(trial, configs[trial], results[trial]['HR@10'], results[trial]['NDCG@10']))
+    best_trial, rung = scheduler.best()
+    print("\nBest config: trial %d %s after %d epochs" % (best_trial, configs[best_trial], budgets[rung]))
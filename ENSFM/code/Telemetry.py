@@ -0,0 +1,95 @@
+import collections
+import contextlib
+import json
+import os
+import resource
+import time
+
+# Run telemetry of the training scripts: wall-clock time per phase of the train and evaluate
+# loops, examples/sec and peak RSS, written as one JSON object per line (JSONL) so runs can be
+# compared with a few lines of pandas or jq. Every record has an "event" ("start", "epoch",
+# "evaluate", "end"), the seconds since the start of the run and the peak RSS so far.
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def default_path(DATA_ROOT, script):
+    return os.path.join(DATA_ROOT, 'runs', '%s-%s-%d.jsonl' % (script, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+
+
+class RunLog(object):
+    '''
+    Phase timers and the JSONL log of one run; without a path the timers still work and
+    nothing is written
+    '''
+
+    def __init__(self, path=None, args=None):
+        self.path = path
+        self.file = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, 'a', buffering=1)
+        self.phases = collections.defaultdict(float)
+        self.start_time = time.time()
+        self.log('start', args=vars(args) if args is not None else None)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start_t
+
+    def take_phases(self):
+        '''
+        :return: {phase: seconds} accumulated since the last call
+        '''
+        phases, self.phases = dict(self.phases), collections.defaultdict(float)
+        return phases
+
+    def log(self, event, **fields):
+        record = dict(event=event, seconds=time.time() - self.start_time, peak_rss_mb=peak_rss_mb(), **fields)
+        if self.file is not None:
+            self.file.write(json.dumps(record, default=float) + '\n')
+        return record
+
+    def close(self):
+        self.log('end')
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class StepProfiler(object):
+    '''
+    TensorFlow profiler trace (TensorBoard profile plugin format) of the training steps
+    start <= step < stop, counted over all epochs of the run
+    '''
+
+    def __init__(self, steps, logdir):
+        '''
+        :param steps: "start:stop", or None to never trace
+        '''
+        self.start, self.stop = [int(v) for v in steps.split(':')] if steps else (None, None)
+        self.logdir = logdir
+        self.running = False
+
+    def step(self, step):
+        # call before running step
+        if self.start is None:
+            return
+        import tensorflow as tf
+        if step == self.start:
+            tf.profiler.experimental.start(self.logdir)
+            self.running = True
+        elif step == self.stop and self.running:
+            self.close()
+
+    def close(self):
+        if self.running:
+            import tensorflow as tf
+            tf.profiler.experimental.stop()
+            self.running = False
+            print('profiler trace of steps %d:%d written to %s' % (self.start, self.stop, self.logdir))
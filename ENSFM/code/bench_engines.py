@@ -0,0 +1,80 @@
+import argparse
+import os
+import time
+import numpy as np
+import tensorflow as tf
+import LoadData as DATA
+import ENSFM_tf2
+from ENSFM import ENSFM
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare the graph and tf2 ENSFM engines")
+    parser.add_argument('--datasets', nargs='?', default='frappe,lastfm,ml-1m',
+                        help='Comma separated datasets under ../data')
+    parser.add_argument('--batch_size', type=int, default=512,
+                        help='batch_size')
+    parser.add_argument('--embed_size', type=int, default=64,
+                        help='Embedding size.')
+    parser.add_argument('--lr', type=float, default=0.05,
+                        help='Learning rate.')
+    parser.add_argument('--negative_weight', type=float, default=0.05,
+                        help='weight of non-observed data')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='Timed training steps per engine')
+    return parser.parse_args()
+
+def _steps_per_sec(step, steps):
+    step()  # warm up / compile
+    start_t = time.time()
+    for _ in range(steps):
+        step()
+    return steps / (time.time() - start_t)
+
+def compare(data, args):
+    '''
+    Check that the tf2 engine reproduces the graph engine on one batch, then time both
+    :return: (max abs score diff, relative loss diff after one step, graph steps/sec, tf2 steps/sec)
+    '''
+    model_args = argparse.Namespace(negative_weight=args.negative_weight, lr=args.lr, score_mode='gemm',
+                                    item_chunk=65536, loss_mode='gram', positives='padded',
+                                    lambda_bilinear=[0.0, 0.0], reg_mode='lazy')
+    u_batch = data.user_train[:args.batch_size].astype(np.int32)
+    i_batch = data.item_train[:args.batch_size].astype(np.int32)
+    u_test = np.array(data.user_test[:128], dtype=np.int32)
+    with tf.Graph().as_default():
+        tf.compat.v1.set_random_seed(2019)
+        sess = tf.compat.v1.Session()
+        deep = ENSFM(data.item_map_list, data.user_field_M, data.item_field_M, args.embed_size, data.max_positive_len, model_args)
+        deep._build_graph()
+        train_op = tf.compat.v1.train.AdagradOptimizer(learning_rate=args.lr, initial_accumulator_value=1e-8).minimize(deep.loss)
+        sess.run(tf.compat.v1.global_variables_initializer())
+    # the module is built eagerly, outside the legacy graph
+    module = ENSFM_tf2.ENSFMModule(data.item_map_list, data.user_field_M, data.item_field_M, args.embed_size, data.max_positive_len, model_args)
+    module.assign_from(sess)
+
+    feed_dict = {deep.input_u: u_batch, deep.input_ur: i_batch, deep.dropout_keep_prob: 1.0}
+    pre = sess.run(deep.pre, {deep.input_u: u_test, deep.dropout_keep_prob: 1.0})
+    q_emb, H_i_emb = module.item_tower()
+    score_diff = np.abs(module.score(u_test, q_emb, H_i_emb).numpy() - pre).max()
+    sess.run(train_op, feed_dict)
+    module.train_step(u_batch, i_batch, 1.0)
+    graph_loss = sess.run(deep.loss, feed_dict)
+    tf2_loss = module.loss(u_batch, i_batch, 1.0)[0].numpy()
+    loss_diff = abs(tf2_loss - graph_loss) / max(abs(graph_loss), 1e-12)
+
+    graph_rate = _steps_per_sec(lambda: sess.run(train_op, feed_dict), args.steps)
+    tf2_rate = _steps_per_sec(lambda: module.train_step(u_batch, i_batch, 1.0)[0].numpy(), args.steps)
+    sess.close()
+    return score_diff, loss_diff, graph_rate, tf2_rate
+
+if __name__ == '__main__':
+    args = parse_args()
+    print("%-10s %16s %16s %14s %14s" % ('dataset', 'max_score_diff', 'rel_loss_diff', 'graph_step/s', 'tf2_step/s'))
+    for dataset in args.datasets.split(','):
+        DATA_ROOT = DATA.get_data_root(dataset)
+        if not os.path.exists(os.path.join(DATA_ROOT, 'train.csv')):
+            print("%-10s skipped: no train.csv in %s" % (dataset, DATA_ROOT))
+            continue
+        data = DATA.LoadData(DATA_ROOT)
+        score_diff, loss_diff, graph_rate, tf2_rate = compare(data, args)
+        print("%-10s %16.3g %16.3g %14.2f %14.2f" % (dataset, score_diff, loss_diff, graph_rate, tf2_rate))
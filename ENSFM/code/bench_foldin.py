@@ -0,0 +1,132 @@
+import argparse
+import copy
+import os
+import time
+import numpy as np
+import LoadData as DATA
+import ServingModel
+import ENSFM_eals
+import FoldIn
+import Metrics
+
+# Fold-in is only meaningful for users the model has not been trained on: a set of test users is
+# held out, one eals model is trained without their training rows and one with them (the retrain
+# that FoldIn saves), and the held-out users are scored from
+#   the model without them, features only
+#   the model without them, folded in from their training items
+#   the model with them (its trained representation)
+# A held-out row can still share features with training rows (frappe rows are user contexts, so
+# the same user id appears in other rows); only its own interactions are held out.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Accuracy and users/sec of FoldIn user representations")
+    parser.add_argument('--dataset', nargs='?', default='frappe',
+                        help='Dataset whose test users are held out and folded in from their training items')
+    parser.add_argument('--holdout', type=int, default=1000,
+                        help='Test users held out of training')
+    parser.add_argument('--epochs', type=int, default=10,
+                        help='eals epochs of both models')
+    parser.add_argument('--embed_size', type=int, default=64,
+                        help='Embedding size')
+    parser.add_argument('--negative_weight', type=float, default=0.05,
+                        help='Weight of non-observed data')
+    parser.add_argument('--lambda_bilinear', nargs=2, type=float, default=[0.0, 0.0],
+                        help='L2 weights of uidW and iidW')
+    parser.add_argument('--out', nargs='?', default=None,
+                        help='Directory of the two ServingModel artifacts (default: <dataset>/runs/foldin)')
+    parser.add_argument('--seed', type=int, default=2019,
+                        help='Seed of the held-out users and of the models')
+    parser.add_argument('--reg', nargs='?', default='0.3,1,3,10',
+                        help='Comma separated ridge weights towards the feature-based user vector, one fold-in row each')
+    parser.add_argument('--batch', type=int, default=1024,
+                        help='Users folded in at once')
+    parser.add_argument('--topK', nargs='?', default='5,10,20',
+                        help='Comma separated cut-offs')
+    return parser.parse_args()
+
+def metrics(data, model, p_emb, user_id, topK, eva_batch=128):
+    engine = Metrics.TopKMetrics(topK)
+    for start in range(0, len(user_id), eva_batch):
+        pre = (p_emb[start:start + eva_batch] * model.H_i_emb.T).dot(model.q_emb.T)[:, :-1]
+        engine.add(data, pre, user_id[start:start + eva_batch])
+    result = engine.result()
+    return [result['HR@%d' % k] for k in topK], [result['NDCG@%d' % k] for k in topK]
+
+def training_rows(data, rows):
+    '''
+    :return: shallow copy of data whose training rows (the fields ENSFM_eals.ENSFMSolver reads) are rows
+    '''
+    _, items, lengths = Metrics.csr_rows(data.Train_data, rows)
+    view = copy.copy(data)
+    view.user_train = data.user_train[rows]
+    view.train_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    view.train_items = items.astype(np.int32)
+    return view
+
+def train(data, directory, bench_args):
+    # an eals model exported as a ServingModel, the input FoldIn takes
+    start_t = time.time()
+    solver = ENSFM_eals.ENSFMSolver(data, bench_args.embed_size, bench_args, bench_args.seed)
+    for epoch in range(bench_args.epochs):
+        solver.epoch()
+    q_emb, H_i_emb = solver.item_tower()
+    ServingModel.export(directory, q_emb, H_i_emb, solver.uidW, solver.u_bias, solver.H_s, solver.bias,
+                        dataset=bench_args.dataset, optimizer='eals', epoch=bench_args.epochs - 1,
+                        negative_weight=bench_args.negative_weight, training_users=len(data.user_train))
+    print("trained on %d users in %.1fs: %s" % (len(data.user_train), time.time() - start_t, directory))
+    return ServingModel.ServingModel(directory)
+
+def direct_solve(folder, input_u, items):
+    # the same optimum with the full [d+1, d+1] system of every user, to check the Woodbury update
+    w, D, q, H = folder.weight1, folder.D, folder.q, folder.H
+    x0 = (folder.model.user_tower(input_u) * H)[:, :D]
+    p_emb = []
+    for b, v in enumerate(items):
+        Qv = q[v]
+        A = w * folder.gram + (1 - w) * Qv.T.dot(Qv)
+        rhs = Qv.sum(0)[:D] - A[:D, D] + folder.reg * x0[b]
+        x = np.linalg.solve(A[:D, :D] + folder.reg * np.eye(D), rhs)
+        p_emb.append(np.append(x, 1.0) / H)
+    return np.array(p_emb)
+
+if __name__ == '__main__':
+    bench_args = parse_args()
+    topK = [int(k) for k in bench_args.topK.split(',')]
+    DATA_ROOT = DATA.get_data_root(bench_args.dataset)
+    data = DATA.LoadData.cached(DATA_ROOT, pad_positives=False)
+    out = bench_args.out or os.path.join(DATA_ROOT, 'runs', 'foldin')
+
+    input_u, user_id = data.unique_test_users()
+    held = np.sort(np.random.RandomState(bench_args.seed).choice(len(user_id), min(bench_args.holdout, len(user_id)), replace=False))
+    input_u, user_id = input_u[held].astype(np.int64), user_id[held]
+    indptr, indices = data.Train_data.indptr, data.Train_data.indices
+    items = [indices[indptr[u]:indptr[u + 1]] for u in user_id]
+    rest = np.setdiff1d(np.arange(len(data.user_train)), user_id)
+    print("holding out %d test users (%d training interactions)" % (len(user_id), sum(len(v) for v in items)))
+    model = train(training_rows(data, rest), os.path.join(out, 'without_held_out'), bench_args)
+    full_model = train(data, os.path.join(out, 'with_held_out'), bench_args)
+
+    start_t = time.time()
+    folder = FoldIn.FoldIn(model)
+    print("item Gram matrix and M^-1 cached in %.1f ms" % (1000 * (time.time() - start_t)))
+
+    check = folder.fold_in(input_u[:64], items[:64])
+    print("max abs diff to the direct per-user solve: %.3g" % np.abs(check - direct_solve(folder, input_u[:64], items[:64])).max())
+
+    print("\n%-34s %s" % ('held-out test users (%d)' % len(user_id), '  '.join('HR@%-3d NDCG@%-3d' % (k, k) for k in topK)))
+    rows = [('without them, features only', model, model.user_tower(input_u))]
+    for reg in [float(reg) for reg in bench_args.reg.split(',')]:
+        rows.append(('without them, fold-in reg=%g' % reg, model, FoldIn.FoldIn(model, reg=reg).fold_in(input_u, items)))
+    rows.append(('trained with them', full_model, full_model.user_tower(input_u)))
+    for name, scorer, p_emb in rows:
+        hr, ndcg = metrics(data, scorer, p_emb, user_id, topK)
+        print("%-34s %s" % (name, '  '.join('%.4f %.4f  ' % (h, n) for h, n in zip(hr, ndcg))))
+
+    # throughput on training users: features from user_train, interactions from the train_indptr/train_items CSR
+    rng = np.random.RandomState(2019)
+    sample = rng.choice(len(data.user_train), min(len(data.user_train), 20 * bench_args.batch), replace=False)
+    batches = [sample[s:s + bench_args.batch] for s in range(0, len(sample), bench_args.batch)]
+    start_t = time.time()
+    for batch in batches:
+        folder.fold_in(data.user_train[batch], [data.train_items[data.train_indptr[i]:data.train_indptr[i + 1]] for i in batch])
+    print("\nfold-in of %d users in batches of %d: %.0f users/sec" % (len(sample), bench_args.batch, len(sample) / (time.time() - start_t)))
@@ -0,0 +1,75 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import numpy as np
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the ENSFM whole-data loss (einsum vs gram)")
+    parser.add_argument('--n_items', nargs='?', default='1000,10000,100000',
+                        help='Comma separated catalog sizes')
+    parser.add_argument('--loss_modes', nargs='?', default='einsum,gram',
+                        help='Comma separated loss modes to compare')
+    parser.add_argument('--embed_size', type=int, default=64,
+                        help='Embedding size.')
+    parser.add_argument('--batch_size', type=int, default=512,
+                        help='batch_size')
+    parser.add_argument('--max_item_pu', type=int, default=50,
+                        help='Padded positive list length')
+    parser.add_argument('--user_fields', type=int, default=8,
+                        help='Feature fields per user')
+    parser.add_argument('--item_fields', type=int, default=2,
+                        help='Feature fields per item')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='Timed training steps per configuration')
+    return parser.parse_args()
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run_config(loss_mode, n_items, args):
+    '''
+    Time Adagrad steps of a synthetic ENSFM graph in the current process
+    :return: (seconds per step, peak RSS in MB, RSS growth during training in MB)
+    '''
+    import tensorflow as tf
+    from ENSFM import ENSFM
+
+    rng = np.random.RandomState(2019)
+    user_field_M = 10 * args.user_fields
+    item_field_M = n_items * args.item_fields
+    item_attribute = rng.randint(0, item_field_M, size=(n_items + 1, args.item_fields)).tolist()
+    u_batch = rng.randint(0, user_field_M, size=(args.batch_size, args.user_fields))
+    i_batch = rng.randint(0, n_items + 1, size=(args.batch_size, args.max_item_pu))
+    model_args = argparse.Namespace(negative_weight=0.01, score_mode='gemm', item_chunk=65536, loss_mode=loss_mode,
+                                    positives='padded', lambda_bilinear=[0.0, 0.0], reg_mode='lazy')
+
+    with tf.Graph().as_default():
+        tf.compat.v1.set_random_seed(2019)
+        sess = tf.compat.v1.Session()
+        with sess.as_default():
+            deep = ENSFM(item_attribute, user_field_M, item_field_M, args.embed_size, args.max_item_pu, model_args)
+            deep._build_graph()
+            train_op = tf.compat.v1.train.AdagradOptimizer(learning_rate=0.01, initial_accumulator_value=1e-8).minimize(deep.loss)
+            sess.run(tf.compat.v1.global_variables_initializer())
+            feed_dict = {deep.input_u: u_batch, deep.input_ur: i_batch, deep.dropout_keep_prob: 1.0}
+            rss_before = _peak_rss_mb()
+            sess.run(train_op, feed_dict)  # warm up
+            start_t = time.time()
+            for _ in range(args.steps):
+                sess.run(train_op, feed_dict)
+            step_time = (time.time() - start_t) / args.steps
+    peak = _peak_rss_mb()
+    return step_time, peak, peak - rss_before
+
+if __name__ == '__main__':
+    args = parse_args()
+    # one fresh process per configuration so that peak RSS is not shared between runs
+    ctx = multiprocessing.get_context('spawn')
+    print("%-8s %10s %14s %14s %14s" % ('loss', 'n_items', 'step_ms', 'peak_rss_MB', 'rss_growth_MB'))
+    for n_items in [int(n) for n in args.n_items.split(',')]:
+        for loss_mode in args.loss_modes.split(','):
+            with ctx.Pool(1) as pool:
+                step_time, peak, growth = pool.apply(run_config, (loss_mode, n_items, args))
+            print("%-8s %10d %14.2f %14.1f %14.1f" % (loss_mode, n_items, step_time * 1000, peak, growth))
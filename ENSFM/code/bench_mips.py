@@ -0,0 +1,71 @@
+import argparse
+import time
+import numpy as np
+import LoadData as DATA
+import ServingModel
+import MipsIndex
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Recall and queries/sec of the MipsIndex top-K retrieval against brute-force scoring")
+    parser.add_argument('--dataset', nargs='?', default='frappe',
+                        help='Dataset whose test users are the queries')
+    parser.add_argument('--export', nargs='?', required=True,
+                        help='ServingModel artifact directory (ENSFM.py --export)')
+    parser.add_argument('--topK', type=int, default=10,
+                        help='Number of items retrieved per user')
+    parser.add_argument('--n_lists', type=int, default=0,
+                        help='IVF lists (0: 4 * sqrt(items))')
+    parser.add_argument('--n_subspaces', type=int, default=0,
+                        help='PQ subspaces (0: dim / 2)')
+    parser.add_argument('--nprobe', nargs='?', default='1,2,4,8,16',
+                        help='Comma separated numbers of lists visited per query')
+    parser.add_argument('--rerank', type=int, default=100,
+                        help='Candidates scored exactly per query')
+    parser.add_argument('--replicate', type=int, default=1,
+                        help='Grow the catalogue to this many perturbed copies of the items, to see how the index scales')
+    parser.add_argument('--batch', type=int, default=128,
+                        help='Queries per batch')
+    return parser.parse_args()
+
+def brute_force(model, extra, input_u, exclude, k):
+    # the evaluate() ranking: exact scores without the padding item, training items masked out
+    pre = model.score(input_u)[:, :-1]
+    if len(extra):
+        pre = np.hstack([pre, model.user_tower(input_u).dot(extra.T)])
+    rows = np.repeat(np.arange(len(input_u)), np.diff(exclude.indptr))
+    pre[rows, exclude.indices] = -np.inf
+    top = np.argpartition(-pre, k, 1)[:, :k]
+    return np.take_along_axis(top, np.argsort(-np.take_along_axis(pre, top, 1), 1), 1)
+
+if __name__ == '__main__':
+    bench_args = parse_args()
+    DATA_ROOT = DATA.get_data_root(bench_args.dataset)
+    data = DATA.LoadData(DATA_ROOT, pad_positives=False)
+    model = ServingModel.ServingModel(bench_args.export, mmap_mode=None)
+    items = model.q_emb[:-1] * model.H_i_emb.T
+    rng = np.random.RandomState(2019)
+    extra = np.concatenate([items * (1 + 0.1 * rng.standard_normal(items.shape)).astype(np.float32)
+                            for _ in range(bench_args.replicate - 1)] + [items[:0]])
+    input_u, user_id = data.unique_test_users()
+    input_u = input_u.astype(np.int32)
+    k = bench_args.topK
+    batches = [(s, min(s + bench_args.batch, len(input_u))) for s in range(0, len(input_u), bench_args.batch)]
+
+    start_t = time.time()
+    reference = np.vstack([brute_force(model, extra, input_u[s:e], data.Train_data[user_id[s:e]], k) for s, e in batches])
+    brute_qps = len(input_u) / (time.time() - start_t)
+
+    start_t = time.time()
+    index = MipsIndex.MipsIndex(np.vstack([items, extra]), n_lists=bench_args.n_lists or None,
+                                n_subspaces=bench_args.n_subspaces or None)
+    print("%d items, %d queries: index of %d lists x %d PQ subspaces built in %.1fs"
+          % (len(items) + len(extra), len(input_u), len(index.centroids), index.n_subspaces, time.time() - start_t))
+    print("\n%-10s %10s %12s %10s" % ('nprobe', 'recall@%d' % k, 'queries/sec', 'speedup'))
+    print("%-10s %10.4f %12.0f %10.2f" % ('exact', 1.0, brute_qps, 1.0))
+    for nprobe in [int(v) for v in bench_args.nprobe.split(',')]:
+        start_t = time.time()
+        found = np.vstack([index.search(model.user_tower(input_u[s:e]), k, nprobe, bench_args.rerank,
+                                        data.Train_data[user_id[s:e]]) for s, e in batches])
+        qps = len(input_u) / (time.time() - start_t)
+        recall = np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(found, reference)])
+        print("%-10d %10.4f %12.0f %10.2f" % (nprobe, recall, qps, qps / brute_qps))
@@ -0,0 +1,65 @@
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+from ENSFM import ENSFM
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark dense vs lazy L2 on the ENSFM embedding tables")
+    parser.add_argument('--vocab_sizes', nargs='?', default='10000,100000,1000000',
+                        help='Comma separated user feature vocabulary sizes (rows of uidW)')
+    parser.add_argument('--reg_modes', nargs='?', default='dense,lazy',
+                        help='Comma separated regularization modes to compare')
+    parser.add_argument('--lambda_bilinear', nargs=2, type=float, default=[1e-4, 1e-4],
+                        help='L2 weights of uidW and iidW')
+    parser.add_argument('--n_items', type=int, default=5000,
+                        help='Catalog size')
+    parser.add_argument('--embed_size', type=int, default=64,
+                        help='Embedding size.')
+    parser.add_argument('--batch_size', type=int, default=512,
+                        help='batch_size')
+    parser.add_argument('--max_item_pu', type=int, default=50,
+                        help='Padded positive list length')
+    parser.add_argument('--user_fields', type=int, default=8,
+                        help='Feature fields per user')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='Timed training steps per configuration')
+    return parser.parse_args()
+
+def run_config(reg_mode, user_field_M, args):
+    '''
+    Time Adagrad steps of a synthetic ENSFM graph
+    :return: seconds per step
+    '''
+    rng = np.random.RandomState(2019)
+    item_field_M = 2 * args.n_items
+    item_attribute = np.stack([np.arange(args.n_items + 1) % args.n_items,
+                               args.n_items + rng.randint(0, args.n_items, args.n_items + 1)], 1).tolist()
+    u_batch = rng.randint(0, user_field_M, size=(args.batch_size, args.user_fields))
+    i_batch = rng.randint(0, args.n_items + 1, size=(args.batch_size, args.max_item_pu))
+    model_args = argparse.Namespace(negative_weight=0.01, score_mode='gemm', item_chunk=65536, loss_mode='gram',
+                                    positives='padded', lambda_bilinear=args.lambda_bilinear, reg_mode=reg_mode)
+    with tf.Graph().as_default():
+        tf.compat.v1.set_random_seed(2019)
+        sess = tf.compat.v1.Session()
+        with sess.as_default():
+            deep = ENSFM(item_attribute, user_field_M, item_field_M, args.embed_size, args.max_item_pu, model_args)
+            deep._build_graph()
+            train_op = tf.compat.v1.train.AdagradOptimizer(learning_rate=0.01, initial_accumulator_value=1e-8).minimize(deep.loss)
+            sess.run(tf.compat.v1.global_variables_initializer())
+            feed_dict = {deep.input_u: u_batch, deep.input_ur: i_batch, deep.dropout_keep_prob: 1.0}
+            sess.run(train_op, feed_dict)  # warm up
+            start_t = time.time()
+            for _ in range(args.steps):
+                sess.run(train_op, feed_dict)
+            step_time = (time.time() - start_t) / args.steps
+        sess.close()
+    return step_time
+
+if __name__ == '__main__':
+    args = parse_args()
+    print("%-8s %12s %12s" % ('reg', 'vocab', 'step_ms'))
+    for user_field_M in [int(n) for n in args.vocab_sizes.split(',')]:
+        for reg_mode in args.reg_modes.split(','):
+            step_time = run_config(reg_mode, user_field_M, args)
+            print("%-8s %12d %12.2f" % (reg_mode, user_field_M, step_time * 1000))
@@ -0,0 +1,257 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+
+# Scaling benchmark of the LoadData -> train -> evaluate pipeline on synthetic datasets.
+# A dataset is generated in the user-features,item-features csv format of train.csv/test.csv:
+#   user fields: a user id field and user_fields - 1 context fields of field_values values each
+#   item fields: an item id field and item_fields - 1 attribute fields of field_values values each
+#   interactions: 1 + Poisson(interactions - 1) items per user, drawn from a Zipf popularity
+#                 distribution of exponent skew (0: uniform), one of them held out for test_users
+#                 of the users
+# One parameter is swept (--sweep, --values) with the others fixed, and every point runs in a
+# fresh process that times LoadData construction, training steps of ENSFM_light (graph engine)
+# and evaluate(), and records peak RSS. The points are written as curves to a JSON file, with
+# the log-log slope of every measure against the swept parameter, and compared against a saved
+# baseline (--baseline, --save_baseline) so a change to ENSFM._pre, _create_loss or LoadData that
+# slows a point down by more than --tolerance is reported as a regression.
+# Other arguments are passed on to ENSFM_light.parse_args, e.g. --loss_mode einsum.
+
+GENERATOR = ['users', 'items', 'user_fields', 'item_fields', 'field_values', 'interactions', 'skew', 'test_users', 'seed']
+MEASURES = ['load_s', 'step_ms', 'eval_s', 'peak_rss_mb']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scaling curves of LoadData, training and evaluate() on synthetic data",
+                                     epilog="Other arguments are passed on to ENSFM_light.parse_args")
+    parser.add_argument('--users', type=int, default=20000,
+                        help='Users')
+    parser.add_argument('--items', type=int, default=4000,
+                        help='Items')
+    parser.add_argument('--user_fields', type=int, default=8,
+                        help='Feature fields per user, including the user id')
+    parser.add_argument('--item_fields', type=int, default=2,
+                        help='Feature fields per item, including the item id')
+    parser.add_argument('--field_values', type=int, default=50,
+                        help='Distinct values of every context/attribute field')
+    parser.add_argument('--interactions', type=float, default=5.0,
+                        help='Mean training interactions per user')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent of item popularity (0: uniform)')
+    parser.add_argument('--test_users', type=float, default=0.1,
+                        help='Fraction of the users with a held-out test interaction')
+    parser.add_argument('--seed', type=int, default=2019,
+                        help='Generator seed')
+    parser.add_argument('--sweep', nargs='?', default='users', choices=GENERATOR[:-2],
+                        help='Parameter to sweep')
+    parser.add_argument('--values', nargs='?', default='5000,10000,20000,40000',
+                        help='Comma separated values of the swept parameter')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='Timed training steps per point (after 3 warm-up steps)')
+    parser.add_argument('--data_dir', nargs='?', default='../data/synthetic',
+                        help='Where the generated datasets are kept (reused while their parameters match)')
+    parser.add_argument('--curves', nargs='?', default=None,
+                        help='JSON output of the curves (default: <data_dir>/curves-<sweep>.json)')
+    parser.add_argument('--plot', nargs='?', default=None,
+                        help='Also plot the curves to this image file (needs matplotlib)')
+    parser.add_argument('--baseline', nargs='?', default=None,
+                        help='Baseline JSON to compare against (written by --save_baseline)')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='Write this run to --baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Relative slowdown or memory growth over the baseline reported as a regression')
+    args, model_argv = parser.parse_known_args()
+    if args.save_baseline and not args.baseline:
+        parser.error('--save_baseline needs --baseline')
+    return args, model_argv
+
+def dataset_name(params):
+    return '-'.join('%s%s' % (name, params[name]) for name in GENERATOR)
+
+def generate(directory, users, items, user_fields, item_fields, field_values, interactions, skew, test_users, seed):
+    '''
+    Write train.csv and test.csv of a synthetic dataset to directory, unless it already holds
+    the dataset of these parameters
+    :return: number of (train, test) lines
+    '''
+    params = dict(users=users, items=items, user_fields=user_fields, item_fields=item_fields, field_values=field_values,
+                  interactions=interactions, skew=skew, test_users=test_users, seed=seed)
+    params_path = os.path.join(directory, 'params.json')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            saved = json.load(f)
+        if saved['params'] == params:
+            return saved['train'], saved['test']
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    # feature ids: the id field first, then every other field in its own block of field_values ids
+    user_features = np.hstack([np.arange(users)[:, None],
+                               users + field_values * np.arange(user_fields - 1) + rng.randint(0, field_values, (users, user_fields - 1))])
+    item_features = np.hstack([np.arange(items)[:, None],
+                               items + field_values * np.arange(item_fields - 1) + rng.randint(0, field_values, (items, item_fields - 1))])
+    user_strings = ['-'.join(map(str, row)) for row in user_features]
+    item_strings = ['-'.join(map(str, row)) for row in item_features]
+
+    popularity = 1.0 / np.arange(1, items + 1) ** skew
+    popularity = popularity[rng.permutation(items)] / popularity.sum()
+    counts = 1 + rng.poisson(max(interactions - 1, 0), users)
+    user_of = np.repeat(np.arange(users), counts)
+    item_of = rng.choice(items, len(user_of), p=popularity)
+    # repeated draws of the same item collapse into one interaction
+    pairs = np.unique(user_of.astype(np.int64) * items + item_of)
+    user_of, item_of = pairs // items, pairs % items
+    # the last interaction of a user with at least two is held out for a test_users fraction of the users
+    last = np.append(user_of[1:] != user_of[:-1], True)
+    multiple = np.bincount(user_of, minlength=users) > 1
+    held_out = last & multiple[user_of] & (rng.rand(users) < test_users)[user_of]
+    # test items are kept to items with training interactions, so every feature id is in train.csv
+    held_out &= np.isin(item_of, item_of[~held_out])
+    order = rng.permutation(int((~held_out).sum()))
+    for name, rows in [('train.csv', np.flatnonzero(~held_out)[order]), ('test.csv', np.flatnonzero(held_out))]:
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(''.join('%s,%s\n' % (user_strings[user_of[r]], item_strings[item_of[r]]) for r in rows))
+    n_train, n_test = int((~held_out).sum()), int(held_out.sum())
+    with open(params_path, 'w') as f:
+        json.dump({'params': params, 'train': n_train, 'test': n_test}, f)
+    return n_train, n_test
+
+def run_point(directory, model_argv, steps):
+    '''
+    Time one synthetic dataset in the current process
+    :return: dict of the measures and dataset statistics
+    '''
+    import LoadData as DATA
+    import ENSFM_light
+    import Telemetry
+
+    start_t = time.time()
+    data = DATA.LoadData(directory, pad_positives=True)
+    load_s = time.time() - start_t
+    load_rss = Telemetry.peak_rss_mb()
+
+    args = ENSFM_light.parse_args(model_argv)
+    if args.engine != 'graph' or args.optimizer != 'adagrad' or args.stack > 1:
+        raise ValueError('bench_scale times the graph engine with adagrad')
+    ENSFM_light.args, ENSFM_light.data = args, data
+    ENSFM_light._build_experiment(args, data, 2019)
+    sess = ENSFM_light.sess
+    _, _, _, iterator_init, iterator_feed, shuffle_seed, inputs = ENSFM_light._experiment
+    n_batches = max(len(data.user_train) // args.batch_size, 1)
+    with sess.graph.as_default(), sess.as_default():
+        if inputs is not None:
+            iterator_feed[shuffle_seed] = 2019
+            sess.run(iterator_init, iterator_feed)
+        step_times = []
+        for step in range(3 + steps):
+            u_batch, i_batch = None, None
+            if inputs is None:
+                start = (step % n_batches) * args.batch_size
+                u_batch = data.user_train[start:start + args.batch_size]
+                i_batch = data.item_train[start:start + args.batch_size]
+            start_t = time.time()
+            ENSFM_light.train_step1(u_batch, i_batch, args)
+            step_times.append(time.time() - start_t)
+        train_rss = Telemetry.peak_rss_mb()
+        start_t = time.time()
+        hr, ndcg = ENSFM_light.evaluate()
+        eval_s = time.time() - start_t
+    return dict(load_s=load_s, step_ms=1000 * np.median(step_times[3:]), eval_s=eval_s, peak_rss_mb=Telemetry.peak_rss_mb(),
+                load_rss_mb=load_rss, train_rss_mb=train_rss, hr10=float(hr), ndcg10=float(ndcg),
+                train_users=len(data.user_train), test_rows=len(data.user_test),
+                eval_users=len(data.unique_test_users()[1]), n_items=data.item_bind_M,
+                user_field_M=data.user_field_M, item_field_M=data.item_field_M, max_positive_len=data.max_positive_len)
+
+def slopes(values, points):
+    # log-log slope of every measure against the swept value: 1 is linear scaling, 2 quadratic
+    x = np.asarray(values, dtype=np.float64)
+    if len(x) < 2 or (x <= 0).any():
+        return {}
+    return {measure: float(np.polyfit(np.log(x), np.log([max(p[measure], 1e-9) for p in points]), 1)[0])
+            for measure in MEASURES}
+
+def compare(baseline, result, tolerance):
+    '''
+    :return: list of (point, measure, baseline value, value) that grew by more than tolerance
+    '''
+    previous = {point['name']: point for point in baseline['points']}
+    regressions = []
+    for point in result['points']:
+        if point['name'] not in previous:
+            continue
+        for measure in MEASURES:
+            old, new = previous[point['name']][measure], point[measure]
+            if new > old * (1 + tolerance):
+                regressions.append((point, measure, old, new))
+    return regressions
+
+def plot(path, result):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is not installed, skipping the plot')
+        return
+    values = [point[result['sweep']] for point in result['points']]
+    fig, axes = plt.subplots(1, len(MEASURES), figsize=(4 * len(MEASURES), 3.5))
+    for ax, measure in zip(axes, MEASURES):
+        ax.plot(values, [point[measure] for point in result['points']], 'o-')
+        ax.set_xlabel(result['sweep'])
+        ax.set_title(measure)
+        if min(values) > 0:
+            ax.set_xscale('log')
+            ax.set_yscale('log')
+    fig.tight_layout()
+    fig.savefig(path)
+    print('plot written to', path)
+
+if __name__ == '__main__':
+    bench_args, model_argv = parse_args()
+    kind = float if bench_args.sweep in ['interactions', 'skew', 'test_users'] else int
+    values = [kind(v) for v in bench_args.values.split(',')]
+    result = {'sweep': bench_args.sweep, 'model_argv': model_argv, 'steps': bench_args.steps, 'points': []}
+    # one fresh process per point so that peak RSS is not shared between points
+    ctx = multiprocessing.get_context('spawn')
+    print("%-12s %10s %10s %10s %10s %10s %10s %12s" % (bench_args.sweep, 'train', 'test', 'max_pos', 'load_s', 'step_ms', 'eval_s', 'peak_rss_MB'))
+    for value in values:
+        params = {name: getattr(bench_args, name) for name in GENERATOR}
+        params[bench_args.sweep] = value
+        directory = os.path.join(bench_args.data_dir, dataset_name(params))
+        n_train, n_test = generate(directory, **params)
+        with ctx.Pool(1) as pool:
+            point = pool.apply(run_point, (directory, model_argv, bench_args.steps))
+        point.update(params, name=dataset_name(params), train_lines=n_train, test_lines=n_test)
+        result['points'].append(point)
+        print("%-12s %10d %10d %10d %10.2f %10.2f %10.2f %12.1f" % (value, n_train, n_test, point['max_positive_len'],
+              point['load_s'], point['step_ms'], point['eval_s'], point['peak_rss_mb']))
+    result['slopes'] = slopes(values, result['points'])
+    if result['slopes']:
+        print("\nlog-log slope against %s: %s" % (bench_args.sweep, ', '.join('%s %.2f' % kv for kv in result['slopes'].items())))
+
+    curves = bench_args.curves or os.path.join(bench_args.data_dir, 'curves-%s.json' % bench_args.sweep)
+    with open(curves, 'w') as f:
+        json.dump(result, f, indent=1, default=float)
+    print('curves written to', curves)
+    if bench_args.plot:
+        plot(bench_args.plot, result)
+
+    if bench_args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(bench_args.baseline)), exist_ok=True)
+        with open(bench_args.baseline, 'w') as f:
+            json.dump(result, f, indent=1, default=float)
+        print('baseline written to', bench_args.baseline)
+    elif bench_args.baseline:
+        with open(bench_args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['model_argv'] != model_argv or baseline['steps'] != bench_args.steps:
+            print('warning: the baseline was run with other arguments (%s, %d steps)' % (' '.join(baseline['model_argv']), baseline['steps']))
+        regressions = compare(baseline, result, bench_args.tolerance)
+        for point, measure, old, new in regressions:
+            print("REGRESSION %s=%s %s: %.3f -> %.3f (+%.0f%%)"
+                  % (bench_args.sweep, point[bench_args.sweep], measure, old, new, 100 * (new / old - 1)))
+        print("%d regressions against %s (tolerance %.0f%%)" % (len(regressions), bench_args.baseline, 100 * bench_args.tolerance))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,88 @@
+import argparse
+import http.client
+import threading
+import time
+import numpy as np
+import LoadData as DATA
+import ServingModel
+import RecommendService
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Closed-loop load generator for RecommendService")
+    parser.add_argument('--export', nargs='?', required=True,
+                        help='ServingModel artifact directory (ENSFM.py --export)')
+    parser.add_argument('--dataset', nargs='?', default='frappe',
+                        help='Dataset whose test users are requested')
+    parser.add_argument('--clients', type=int, default=32,
+                        help='Concurrent clients, each sending its next request when the last one is answered')
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='Requests per setting')
+    parser.add_argument('--topK', type=int, default=10,
+                        help='k of every request')
+    parser.add_argument('--settings', nargs='?', default='1:0,16:2,128:5',
+                        help='Comma separated max_batch:max_wait_ms service settings to compare')
+    parser.add_argument('--transport', nargs='?', default='http', choices=['http', 'direct'],
+                        help='http: requests through the local server; direct: clients call MicroBatcher.submit, '
+                             'which leaves out the HTTP overhead to show the batching alone')
+    return parser.parse_args()
+
+def client(port, users, k, latencies):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    for user in users:
+        start_t = time.time()
+        connection.request('GET', '/recommend?user=%s&k=%d' % (user, k))
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError('request for %s failed with status %d' % (user, response.status))
+        latencies.append(time.time() - start_t)
+    connection.close()
+
+def direct_client(batcher, users, k, latencies):
+    for user in users:
+        start_t = time.time()
+        batcher.submit([int(feature) for feature in user.split('-')], user, k).result()
+        latencies.append(time.time() - start_t)
+
+def run_load(batcher, users, clients, k, transport='http'):
+    '''
+    :return: (client-side latencies in seconds, wall time)
+    '''
+    latencies = []
+    if transport == 'http':
+        server = RecommendService.make_server(batcher, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        threads = [threading.Thread(target=client, args=(server.server_address[1], users[i::clients], k, latencies))
+                   for i in range(clients)]
+    else:
+        threads = [threading.Thread(target=direct_client, args=(batcher, users[i::clients], k, latencies))
+                   for i in range(clients)]
+    start_t = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start_t
+    if transport == 'http':
+        server.shutdown()
+        server.server_close()
+    return np.array(latencies), wall
+
+if __name__ == '__main__':
+    bench_args = parse_args()
+    data = DATA.LoadData.cached(DATA.get_data_root(bench_args.dataset), pad_positives=False)
+    model = ServingModel.ServingModel(bench_args.export)
+    rng = np.random.RandomState(2019)
+    test_users = ["-".join([str(feature) for feature in one]) for one in data.user_test]
+    users = [test_users[i] for i in rng.randint(len(test_users), size=bench_args.requests)]
+    print("%d %s requests from %d clients per setting" % (bench_args.requests, bench_args.transport, bench_args.clients))
+    print("\n%-10s %-8s %10s %10s %10s %12s" % ('max_batch', 'wait_ms', 'p50_ms', 'p99_ms', 'mean_batch', 'requests/s'))
+    for setting in bench_args.settings.split(','):
+        max_batch, max_wait_ms = setting.split(':')
+        batcher = RecommendService.MicroBatcher(model, data, int(max_batch), float(max_wait_ms), bench_args.requests)
+        latencies, wall = run_load(batcher, users, bench_args.clients, bench_args.topK, bench_args.transport)
+        stats = batcher.stats()
+        batcher.close()
+        p50, p99 = np.percentile(latencies * 1000.0, [50, 99])
+        print("%-10s %-8s %10.2f %10.2f %10.1f %12.0f"
+              % (max_batch, max_wait_ms, p50, p99, stats['mean_batch'], len(latencies) / wall))
@@ -0,0 +1,73 @@
+import argparse
+import os
+import time
+import LoadData as DATA
+import ENSFM_light
+import ENSFM_eals
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare Adagrad and the eals coordinate descent solver on epochs and time to a target NDCG@10",
+                                     epilog="Other arguments are passed on to ENSFM_light.parse_args")
+    parser.add_argument('--adagrad_epochs', type=int, default=100,
+                        help='Adagrad epoch budget')
+    parser.add_argument('--eals_epochs', type=int, default=20,
+                        help='eals epoch budget')
+    parser.add_argument('--target', type=float, default=0.45,
+                        help='Target NDCG@10')
+    bench_args, model_argv = parser.parse_known_args()
+    # Adagrad runs on its fastest input path
+    model_args = ENSFM_light.parse_args(model_argv + ['--positives', 'ragged', '--input_pipeline', 'tfdata'])
+    return bench_args, model_args
+
+def adagrad_curve(args, data, epochs, random_seed=2019):
+    '''
+    :return: generator of (epoch, training seconds so far, NDCG@10)
+    '''
+    ENSFM_light._build_experiment(args, data, random_seed)
+    _, _, _, iterator_init, iterator_feed, shuffle_seed, _ = ENSFM_light._experiment
+    iterator_feed[shuffle_seed] = random_seed
+    ENSFM_light.sess.run(iterator_init, iterator_feed)
+    steps = len(data.user_train) // args.batch_size
+    train_time = 0.0
+    for epoch in range(epochs):
+        start_t = time.time()
+        for _ in range(steps):
+            ENSFM_light.train_step1(None, None, args)
+        train_time += time.time() - start_t
+        yield epoch, train_time, ENSFM_light.evaluate()[1]
+
+def eals_curve(args, data, epochs, random_seed=2019):
+    start_t = time.time()
+    ENSFM_light.deep = ENSFM_eals.ENSFMSolver(data, args.embed_size, args, random_seed)
+    train_time = time.time() - start_t
+    for epoch in range(epochs):
+        start_t = time.time()
+        ENSFM_light.deep.epoch()
+        train_time += time.time() - start_t
+        yield epoch, train_time, ENSFM_light.evaluate()[1]
+
+if __name__ == '__main__':
+    bench_args, args = parse_args()
+    DATA_ROOT = DATA.get_data_root(args.dataset)
+    if not os.path.exists(os.path.join(DATA_ROOT, 'train.csv')):
+        raise SystemExit("no train.csv in %s" % DATA_ROOT)
+    data = DATA.LoadData(DATA_ROOT, pad_positives=False)
+    ENSFM_light.args, ENSFM_light.data = args, data
+    rows = []
+    for optimizer, curve, epochs in [('adagrad', adagrad_curve, bench_args.adagrad_epochs),
+                                     ('eals', eals_curve, bench_args.eals_epochs)]:
+        args.optimizer = optimizer
+        reached, best = None, (0.0, None)
+        for epoch, train_time, ndcg in curve(args, data, epochs):
+            print("%s epoch %d: train time %.1fs, NDCG@10 %.4f" % (optimizer, epoch, train_time, ndcg))
+            best = max(best, (ndcg, epoch))
+            if ndcg >= bench_args.target:
+                reached = (epoch + 1, train_time)
+                break
+        rows.append((optimizer, reached, best))
+    print("\n%-8s %18s %18s %12s" % ('solver', 'epochs_to_target', 'seconds_to_target', 'best_NDCG@10'))
+    for optimizer, reached, (ndcg, epoch) in rows:
+        if reached is None:
+            print("%-8s %18s %18s %12.4f" % (optimizer, 'not reached', '-', ndcg))
+        else:
+            print("%-8s %18d %18.1f %12.4f" % (optimizer, reached[0], reached[1], ndcg))
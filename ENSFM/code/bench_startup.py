@@ -0,0 +1,50 @@
+import argparse
+import subprocess
+import sys
+import time
+
+# wall time of `python cli.py <command> ...` and whether the command imported TensorFlow
+COMMANDS = [
+    ['train', '--help'],
+    ['search', '--help'],
+    ['search', '--scheduler', 'asha', '--help'],
+    ['load', '--help'],
+    ['evaluate', '--help'],
+    ['export', '--help'],
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Startup time of every cli.py command")
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Runs per command; the fastest one is reported')
+    parser.add_argument('--dataset', nargs='?', default='frappe',
+                        help='Dataset of the load command (needs its train.csv)')
+    return parser.parse_args()
+
+def startup(argv, repeats):
+    '''
+    :return: (fastest wall seconds, cumulative seconds of the tensorflow import or None)
+    '''
+    best, tf_seconds = float('inf'), None
+    for _ in range(repeats):
+        start_t = time.time()
+        run = subprocess.run([sys.executable, '-X', 'importtime'] + argv, capture_output=True, text=True)
+        best = min(best, time.time() - start_t)
+        if run.returncode != 0:
+            raise RuntimeError('%s failed:\n%s' % (' '.join(argv), run.stderr[-2000:]))
+        # -X importtime lines: "import time: self [us] | cumulative | imported package"
+        for line in run.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == 'tensorflow':
+                tf_seconds = int(fields[1]) / 1e6
+    return best, tf_seconds
+
+if __name__ == '__main__':
+    bench_args = parse_args()
+    rows = [(['-c', 'pass'], 'python'), (['-c', 'import tensorflow'], 'import tensorflow')]
+    rows += [(['cli.py'] + argv, 'cli.py ' + ' '.join(argv)) for argv in COMMANDS]
+    rows.append((['cli.py', 'load', '--dataset', bench_args.dataset], 'cli.py load --dataset %s' % bench_args.dataset))
+    print("%-40s %10s %16s" % ('command', 'seconds', 'tensorflow (s)'))
+    for argv, name in rows:
+        seconds, tf_seconds = startup(argv, bench_args.repeats)
+        print("%-40s %10.2f %16s" % (name, seconds, '-' if tf_seconds is None else '%.2f' % tf_seconds))
@@ -0,0 +1,96 @@
+import argparse
+import runpy
+import sys
+import time
+import LoadData as DATA
+
+# One entry point for the ENSFM scripts: python cli.py <command> [arguments]
+#   load      parse a dataset's csv files into its LoadData cache (a no-op if the cache is current)
+#   train     ENSFM.py, or ENSFM_light.py with --light, on the remaining arguments
+#   search    SearchRunner.py, or SuccessiveHalving.py with --scheduler asha, on the remaining arguments
+#   evaluate  HR, Recall, Precision, NDCG and MRR of a ServingModel artifact on a dataset's test users
+#   export    checkpoint to ServingModel artifact
+# Only train and search import TensorFlow, and only after their arguments are parsed (see
+# ENSFM.import_tf), so --help and argument errors are instant; the other commands are NumPy only.
+# bench_startup.py measures the startup time of every command.
+
+SCRIPTS = {('train', False): 'ENSFM', ('train', True): 'ENSFM_light',
+           ('search', 'grid'): 'SearchRunner', ('search', 'asha'): 'SuccessiveHalving'}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ENSFM command line", allow_abbrev=False)
+    commands = parser.add_subparsers(dest='command', required=True)
+    load = commands.add_parser('load', help='Build or check the LoadData cache of a dataset')
+    load.add_argument('--dataset', nargs='?', default='frappe',
+                      help='Dataset to load')
+    load.add_argument('--cache_dir', nargs='?', default=None,
+                      help='Cache directory (default: <dataset dir>/cache)')
+    load.add_argument('--padded', action='store_true',
+                      help='Also cache the padded positive lists of --positives padded')
+    # train and search pass --help and everything else on to their script
+    train = commands.add_parser('train', help='Train with ENSFM.py (arguments as for ENSFM.py)', add_help=False, allow_abbrev=False)
+    train.add_argument('--light', action='store_true',
+                       help='Run the ENSFM_light.py hyperparameter grid instead')
+    search = commands.add_parser('search', help='Parallel hyperparameter search (arguments as for SearchRunner.py)',
+                                 add_help=False, allow_abbrev=False)
+    search.add_argument('--scheduler', nargs='?', default='grid', choices=['grid', 'asha'],
+                        help='grid: SearchRunner.py; asha: SuccessiveHalving.py')
+    evaluate = commands.add_parser('evaluate', help='Evaluate a ServingModel artifact on a test set')
+    evaluate.add_argument('--export', nargs='?', required=True,
+                          help='ServingModel artifact directory')
+    evaluate.add_argument('--dataset', nargs='?', default='frappe',
+                          help='Dataset to evaluate on')
+    evaluate.add_argument('--topK', nargs='?', default='5,10,20',
+                          help='Comma separated cut-offs')
+    export = commands.add_parser('export', help='Export a checkpoint of ENSFM.py as a ServingModel artifact')
+    export.add_argument('--checkpoint', nargs='?', required=True,
+                        help='Checkpoint file, or directory whose latest checkpoint is exported')
+    export.add_argument('--dataset', nargs='?', default='frappe',
+                        help='Dataset the checkpoint was trained on (for the item features)')
+    export.add_argument('--out', nargs='?', required=True,
+                        help='Artifact directory')
+    return parser.parse_known_args(argv)
+
+def run_script(name, argv):
+    sys.argv = [name + '.py'] + argv
+    runpy.run_module(name, run_name='__main__', alter_sys=True)
+
+def load(args):
+    start_t = time.time()
+    data = DATA.LoadData.cached(DATA.get_data_root(args.dataset), args.cache_dir, args.padded)
+    test_users = len(data.unique_test_users()[1])
+    print("%d users, %d items, %d training interactions, %d test rows of %d test users in %.2fs"
+          % (data.user_bind_M, data.item_bind_M, data.Train_data.nnz, len(data.user_test), test_users, time.time() - start_t))
+
+def evaluate(args):
+    import ServingModel
+    import Metrics
+    topK = [int(k) for k in args.topK.split(',')]
+    data = DATA.LoadData.cached(DATA.get_data_root(args.dataset), pad_positives=False)
+    model = ServingModel.ServingModel(args.export)
+    eva_batch = 128
+    engine = Metrics.TopKMetrics(topK)
+    user_features, test_user_id = data.unique_test_users()
+    for start in range(0, len(user_features), eva_batch):
+        u_batch = user_features[start:start + eva_batch]
+        engine.add(data, model.score(u_batch)[:, :-1], test_user_id[start:start + eva_batch])
+    metrics = engine.result()
+    for k in topK:
+        print(', '.join('%s@%d: %.4f' % (name, k, metrics['%s@%d' % (name, k)]) for name in Metrics.NAMES))
+
+def export(args):
+    import Checkpoint
+    import ServingModel
+    checkpoint = Checkpoint.checkpoint_path(args.checkpoint)
+    data = DATA.LoadData.cached(DATA.get_data_root(args.dataset), pad_positives=False)
+    ServingModel.export_checkpoint(args.out, checkpoint, data.item_map_list, dataset=args.dataset, source=checkpoint)
+    print("exported %s to %s" % (checkpoint, args.out))
+
+if __name__ == '__main__':
+    args, rest = parse_args()
+    if args.command in ['train', 'search']:
+        run_script(SCRIPTS[args.command, args.light if args.command == 'train' else args.scheduler], rest)
+    else:
+        if rest:
+            raise SystemExit('unrecognized arguments: %s' % ' '.join(rest))
+        {'load': load, 'evaluate': evaluate, 'export': export}[args.command](args)